@@ -0,0 +1,159 @@
+import benchmarks.synthetic_city as synthetic_city
+import helper_scripts.data_processor as data_processor
+import helper_scripts.dz_creator as dz_creator
+import darkzones
+import pandas as pd
+import json, os, time, tempfile, tracemalloc
+import argparse
+
+def measure(function, *args, track_memory=True, **kwargs):
+    """     Runs function and measures the time it took and its peak of memory (Python allocations, in MB)
+    Memory allocated by the worker processes of make_models is not included.
+    """
+    if track_memory:
+        tracemalloc.start()
+    start_time = time.perf_counter()
+    result = function(*args, **kwargs)
+    seconds = time.perf_counter() - start_time
+    peak_mb = None
+    if track_memory:
+        peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return result, seconds, peak_mb
+
+def run_stages(df_raw, litters, n_jobs=-1, track_memory=True):
+    """     Times every stage of the pipeline separately on the raw readings
+    Must be run from the folder of the synthetic city (see synthetic_city.create_city)
+
+    Returns
+    -------
+    results : list
+        One dictionary per stage with 'stage', 'seconds', 'peak_mb', 'rows_in' and 'rows_out'
+    """
+    results = []
+    def stage(name, function, df, *args, **kwargs):
+        rows_in = len(df)
+        result, seconds, peak_mb = measure(function, df, *args, track_memory=track_memory, **kwargs)
+        rows_out = len(result) if hasattr(result, '__len__') else None
+        results.append({'stage': name, 'seconds': round(seconds, 4), 'peak_mb': None if peak_mb is None else round(peak_mb, 2),
+                        'rows_in': rows_in, 'rows_out': rows_out})
+        return result
+    df = stage('clean_df', data_processor.clean_df, df_raw.copy())
+    df = stage('aggregate_df', data_processor.aggregate_df, df)
+    df = stage('create_date_features', data_processor.create_date_features, df)
+    df = stage('create_coordinates_features', data_processor.create_coordinates_features, df)
+    df = stage('create_weather_features', data_processor.create_weather_features, df)
+    df = stage('create_osm_features', data_processor.create_osm_features, df)
+    import helper_scripts.train as train
+    models = stage('make_models', train.make_models, df, litters, n_jobs=n_jobs)
+    stage('create_darkzones', dz_creator.create_darkzones, df_raw.copy())
+    stage('predict_darkzones', darkzones.predict_darkzones, df_raw.copy(), models)
+    return results
+
+def run_scaling(scale_by='days', factors=(1, 2, 4), n_edges=500, n_days=30, detections_per_day=1000, n_amenities=1000,
+                litters=('1', '2', '4', '21'), n_jobs=-1, track_memory=True, seed=42, warmup=True):
+    """     Runs all the stages on synthetic cities of growing size
+    The size given by scale_by ('edges', 'days', 'detections' or 'amenities') is multiplied by each factor.
+    With warmup, the stages first run once on a tiny city, so lazy imports and the start of the
+        worker processes are not counted in the first factor.
+
+    Returns
+    -------
+    df_results : pandas.dataframe
+        One row per stage and factor, with the size of the city and the measures of run_stages
+    """
+    sizes = {'edges': n_edges, 'days': n_days, 'detections': detections_per_day, 'amenities': n_amenities}
+    if scale_by not in sizes:
+        raise ValueError(f"scale_by must be one of {list(sizes)}")
+    current_dir = os.getcwd()
+    results = []
+    cities = [(factor, dict(sizes, **{scale_by: int(sizes[scale_by] * factor)})) for factor in factors]
+    if warmup:
+        cities.insert(0, (None, {'edges': 20, 'days': 3, 'detections': 50, 'amenities': 20}))
+    for factor, city in cities:
+        with tempfile.TemporaryDirectory() as out_dir:
+            df_raw = synthetic_city.create_city(out_dir, n_edges=city['edges'], n_days=city['days'],
+                                                detections_per_day=city['detections'], n_amenities=city['amenities'],
+                                                litters=litters, seed=seed)
+            os.chdir(out_dir)  #<-- The pipeline reads its files from the relative 'data' folder
+            try:
+                for result in run_stages(df_raw, list(litters), n_jobs=n_jobs, track_memory=track_memory):
+                    if factor is not None:
+                        results.append({'factor': factor, **city, **result})
+            finally:
+                os.chdir(current_dir)
+    return pd.DataFrame(results)
+
+def run_update_scaling(new_days=(1, 2, 4, 8), n_edges=3000, n_days=60, detections_per_day=3000, n_amenities=2000,
+                       litters=('1', '2', '4', '21'), n_jobs=-1, seed=42):
+    """     Times incremental.update_models against training again with make_models
+    The models are trained on the history of a synthetic city without its last new_days days,
+        then updated with those days. The time of the update should grow with the new rows, and
+        stay well below the time of training on all the days.
+
+    Returns
+    -------
+    df_results : pandas.dataframe
+        One row per number of new days, with the new 'rows', the 'update_seconds' and the
+            'retrain_seconds' of make_models on all the rows
+    """
+    import helper_scripts.train as train
+    import helper_scripts.incremental as incremental
+    current_dir = os.getcwd()
+    results = []
+    with tempfile.TemporaryDirectory() as out_dir:
+        df_raw = synthetic_city.create_city(out_dir, n_edges=n_edges, n_days=n_days, detections_per_day=detections_per_day,
+                                            n_amenities=n_amenities, litters=litters, seed=seed)
+        os.chdir(out_dir)
+        try:
+            df = darkzones.add_features(data_processor.aggregate_df(data_processor.clean_df(df_raw)))
+        finally:
+            os.chdir(current_dir)
+    dates = sorted(df['date_utc'].unique())
+    _, retrain_seconds, _ = measure(train.make_models, df, list(litters), n_jobs=n_jobs, track_memory=False)
+    for days in new_days:
+        df_history = df[df['date_utc'] < dates[-days]].reset_index(drop=True)
+        df_new = df[df['date_utc'] >= dates[-days]].reset_index(drop=True)
+        models = train.make_models(df_history, list(litters), n_jobs=n_jobs)
+        state = incremental.create_update_state(models, df_history)
+        _, update_seconds, _ = measure(incremental.update_models, models, df_new, state, n_jobs=n_jobs, track_memory=False)
+        results.append({'new_days': days, 'rows': len(df_new), 'history_rows': len(df_history),
+                        'update_seconds': round(update_seconds, 4), 'retrain_seconds': round(retrain_seconds, 4)})
+    return pd.DataFrame(results)
+
+def scaling_table(df_results, measure_column='seconds'):
+    """     Stage x factor table of one measure, the scaling curve of every stage
+    """
+    return df_results.pivot(index='stage', columns='factor', values=measure_column).reindex(df_results['stage'].unique())
+
+if __name__ == '__main__':
+    # Run from the src folder, E.g.: python -m benchmarks.run_benchmarks --scale-by days --factors 1 2 4
+    parser = argparse.ArgumentParser(description='Benchmark every stage of the pipeline on synthetic cities')
+    parser.add_argument('--scale-by', default='days', choices=['edges', 'days', 'detections', 'amenities'])
+    parser.add_argument('--factors', type=float, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--edges', type=int, default=500)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--detections', type=int, default=1000, help='Readings per day')
+    parser.add_argument('--amenities', type=int, default=1000)
+    parser.add_argument('--litters', nargs='+', default=['1', '2', '4', '21'])
+    parser.add_argument('--n-jobs', type=int, default=-1)
+    parser.add_argument('--no-memory', action='store_true', help='Do not trace memory (tracing slows down the stages)')
+    parser.add_argument('--output', help='Write all the results to this JSON file')
+    parser.add_argument('--updates', action='store_true', help='Time the incremental updates against training again instead')
+    args = parser.parse_args()
+    if args.updates:
+        df_results = run_update_scaling(n_edges=args.edges, n_days=args.days, detections_per_day=args.detections,
+                                        n_amenities=args.amenities, litters=args.litters, n_jobs=args.n_jobs)
+        print(df_results)
+    else:
+        df_results = run_scaling(args.scale_by, args.factors, args.edges, args.days, args.detections, args.amenities,
+                                 args.litters, args.n_jobs, not args.no_memory)
+        pd.set_option('display.width', 200)
+        print(f"Seconds per stage, scaling {args.scale_by} by {args.factors}")
+        print(scaling_table(df_results, 'seconds'))
+        if not args.no_memory:
+            print(f"\nPeak memory (MB) per stage, scaling {args.scale_by} by {args.factors}")
+            print(scaling_table(df_results, 'peak_mb'))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(df_results.to_dict(orient='records'), file, indent=4)
@@ -0,0 +1,127 @@
+import helper_scripts.data_processor as data_processor
+import helper_scripts.osm_cache as osm_cache
+import pandas as pd
+import numpy as np
+import json, os
+
+def create_edges(n_edges, rng, center=(47.555, 7.59), spread=0.02):
+    """     Random street edges around the center, as in the edges.geojson features
+    Returns a dataframe with 'edge_id', 'edge_osmid', 'osm_highway', the bbox corners and 'length'
+    """
+    u = np.arange(n_edges) + 100000
+    lat = center[0] + rng.uniform(-spread, spread, n_edges)
+    lon = center[1] + rng.uniform(-spread, spread, n_edges) * 1.5
+    lat_end = lat + rng.uniform(-0.002, 0.002, n_edges)
+    lon_end = lon + rng.uniform(-0.003, 0.003, n_edges)
+    df_edges = pd.DataFrame({'edge_id': [f"({a}, {a + 500000}, 0)" for a in u],
+                             'edge_osmid': u + 2000000,
+                             'osm_highway': rng.choice(['residential', 'footway', 'primary', 'secondary', 'service'], n_edges),
+                             'lon_a': lon, 'lat_a': lat, 'lon_b': lon_end, 'lat_b': lat_end})
+    df_edges['length'] = np.hypot((lat_end - lat) * 111320, (lon_end - lon) * 75000).round(3)
+    return df_edges
+
+def write_edges_geojson(df_edges, file_path):
+    """     Writes the edges with the same structure as data/edges.geojson
+    """
+    features = []
+    for row in df_edges.itertuples():
+        features.append({'type': 'Feature', 'id': row.edge_id,
+                         'bbox': [row.lon_a, row.lat_a, row.lon_b, row.lat_b],
+                         'properties': {'osmid': int(row.edge_osmid), 'highway': row.osm_highway, 'length': row.length},
+                         'geometry': {'type': 'LineString', 'coordinates': [[row.lon_a, row.lat_a], [row.lon_b, row.lat_b]]}})
+    with open(file_path, 'w') as file:
+        json.dump({'type': 'FeatureCollection', 'features': features}, file)
+
+def create_raw_readings(df_edges, dates, detections_per_day, litters, rng, coverage=0.4):
+    """     Raw readings with the same columns as Cortexia's export (input of clean_df)
+    Each day the sweepers scan about coverage of the edges, the litter counts are Poisson with
+        a rate that depends on the edge and the weekday
+    """
+    n_rows = detections_per_day * len(dates)
+    day = np.repeat(np.arange(len(dates)), detections_per_day)
+    n_scanned = max(1, int(len(df_edges) * coverage))
+    scanned = np.concatenate([rng.choice(len(df_edges), n_scanned, replace=False) for _ in dates])
+    edge = scanned[day * n_scanned + rng.integers(0, n_scanned, n_rows)]
+    timestamps = pd.to_datetime(np.asarray(dates)[day]) + pd.to_timedelta(rng.integers(0, 86400, n_rows), unit='s')
+    edge_rate = rng.gamma(2.0, 0.5, len(df_edges))
+    weekday_rate = np.where(pd.DatetimeIndex(timestamps).weekday >= 5, 1.5, 1.0)
+    df = pd.DataFrame({'Unnamed: 0': np.arange(n_rows),
+                       '_id': np.arange(n_rows),
+                       'suitcase.id': rng.integers(1, 6, n_rows),
+                       'date.utc': timestamps.strftime('%Y-%m-%d %H:%M:%S'),
+                       'edge.id': df_edges['edge_id'].to_numpy()[edge],
+                       'edge.osmid': df_edges['edge_osmid'].to_numpy()[edge],
+                       'osm.highway': df_edges['osm_highway'].to_numpy()[edge],
+                       'place.id': 'basel',
+                       'value.Vehicle_Mode': 0,
+                       'speed': 0})
+    for i, litter in enumerate(litters):
+        df[str(litter)] = rng.poisson(edge_rate[edge] * weekday_rate * (1 + i % 3) * 0.3)
+    return df
+
+def write_weather_csv(dates, file_path, rng):
+    """     Writes daily weather for the dates, with the same header rows as the meteoblue export
+    """
+    header = [['location'] + ['Basel'] * 13]
+    for name in ['lat', 'lon', 'asl', 'variable', 'unit', 'level', 'resolution', 'aggregation', 'timestamp']:
+        header.append([name] + [''] * 13)
+    n_dates = len(dates)
+    season = np.cos(2 * np.pi * (pd.DatetimeIndex(dates).dayofyear.to_numpy() - 200) / 365)
+    temperature = 12 + 10 * season + rng.normal(0, 3, n_dates)
+    values = np.column_stack([temperature + 5, temperature - 5, temperature,
+                              rng.exponential(2, n_dates), np.where(temperature < 0, rng.exponential(1, n_dates), 0),
+                              rng.uniform(70, 100, n_dates), rng.uniform(30, 70, n_dates), rng.uniform(50, 85, n_dates),
+                              rng.uniform(0, 100, n_dates), rng.uniform(10, 40, n_dates), rng.uniform(0, 10, n_dates),
+                              rng.uniform(5, 20, n_dates), rng.uniform(0, 360, n_dates)])
+    rows = [[pd.Timestamp(date).strftime('%Y%m%dT0000')] + list(np.round(row, 4)) for date, row in zip(dates, values)]
+    pd.DataFrame(header + rows).to_csv(file_path, header=False, index=False)
+
+def create_amenities(df_edges, n_amenities, rng):
+    """     Random amenities, half of them near an edge so the OSM features are not empty
+    """
+    near = rng.integers(0, len(df_edges), n_amenities)
+    lat = np.where(np.arange(n_amenities) % 2 == 0,
+                   (df_edges['lat_a'].to_numpy()[near] + df_edges['lat_b'].to_numpy()[near]) / 2,
+                   rng.uniform(df_edges['lat_a'].min(), df_edges['lat_a'].max(), n_amenities))
+    lon = np.where(np.arange(n_amenities) % 2 == 0,
+                   (df_edges['lon_a'].to_numpy()[near] + df_edges['lon_b'].to_numpy()[near]) / 2,
+                   rng.uniform(df_edges['lon_a'].min(), df_edges['lon_a'].max(), n_amenities))
+    return pd.DataFrame({'amenity': rng.choice(data_processor.create_osm_columns(), n_amenities), 'lat': lat, 'lon': lon})
+
+def create_city(out_dir, n_edges=500, n_days=60, detections_per_day=2000, n_amenities=1000,
+                litters=('1', '2', '4', '21'), start_date='2021-01-01', seed=42, place='Basel, Basel, Switzerland'):
+    """     Creates a synthetic city in out_dir, laid out like the src folder
+    Writes:
+        'data/edges.geojson' : The street edges
+        'data/weather_basel_2021-2022.csv' : Daily weather for the dates, same format as the meteoblue export
+        'data/amenities.csv' : The amenity fixture, also loaded into the OSM cache ('data/osm_cache')
+        'raw.csv' : The raw readings
+
+    Parameters
+    ----------
+    out_dir : string
+        Folder of the synthetic city, the pipeline has to be run from this folder
+    n_edges, n_days, detections_per_day, n_amenities : int
+        Size of the city
+    litters : list
+        Numerical values of the litter columns
+
+    Returns
+    -------
+    df : pandas.dataframe
+        The raw readings, input of train_models() and predict_darkzones()
+    """
+    rng = np.random.default_rng(seed)
+    data_dir = os.path.join(out_dir, 'data')
+    os.makedirs(data_dir, exist_ok=True)
+    dates = pd.date_range(start_date, periods=n_days).date
+    df_edges = create_edges(n_edges, rng)
+    write_edges_geojson(df_edges, os.path.join(data_dir, 'edges.geojson'))
+    write_weather_csv(dates, os.path.join(data_dir, 'weather_basel_2021-2022.csv'), rng)
+    df_amenities = create_amenities(df_edges, n_amenities, rng)
+    df_amenities.to_csv(os.path.join(data_dir, 'amenities.csv'), index=False)
+    tags = {'amenity': sorted(data_processor.create_osm_columns())}
+    osm_cache.import_amenities(os.path.join(data_dir, 'amenities.csv'), place, tags, os.path.join(data_dir, 'osm_cache'))
+    df = create_raw_readings(df_edges, dates, detections_per_day, litters, rng)
+    df.to_csv(os.path.join(out_dir, 'raw.csv'), index=False)
+    return df
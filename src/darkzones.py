@@ -1,9 +1,30 @@
 import helper_scripts.data_processor as data_processor
-import helper_scripts.train as train
 import helper_scripts.dz_creator as dz_creator
+import helper_scripts.feature_store as feature_store
+import helper_scripts.bundle as bundle
+import helper_scripts.instrumentation as instrumentation
+import pandas as pd
 import numpy as np
+import os
+# helper_scripts.train, predictor and incremental import sklearn, so they are only imported by
+#   the functions that need them. A bundle (see bundle.export_models) predicts without sklearn.
 
-def train_models(df, litters, aggregation_method='sum'):
+def add_features(df, store_dir=None, report=None):
+    """     Adds the date, coordinates, weather and OSM features
+    With store_dir, the features are joined from the feature store in that folder and only
+        computed for the edges and dates that are not stored yet
+    With report (see instrumentation.create_report), every feature merge is added as a stage
+    """
+    if store_dir is not None:
+        return instrumentation.run_stage(report, 'join_features', feature_store.join_features, df, store_dir, merge=True)
+    df = instrumentation.run_stage(report, 'create_date_features', data_processor.create_date_features, df, merge=True)
+    df = instrumentation.run_stage(report, 'create_coordinates_features', data_processor.create_coordinates_features, df, merge=True)
+    df = instrumentation.run_stage(report, 'create_weather_features', data_processor.create_weather_features, df, merge=True)
+    df = instrumentation.run_stage(report, 'create_osm_features', data_processor.create_osm_features, df, merge=True)
+    return df
+
+def train_models(df, litters, aggregation_method='sum', store_dir=None, return_report=False, sink=None, track_memory=True,
+                 params=None):
     """     Train ML prediciton models
 
     Parameters
@@ -14,6 +35,17 @@ def train_models(df, litters, aggregation_method='sum'):
         List containig the numerical values of the desired litters to train the ML models
     aggregation_method : string
         The type of aggregation when grouping by edge_id and date
+    store_dir : string
+        Folder of the feature store, by default (None) all the features are computed again
+    return_report : boolean
+        Also return the run report, with the seconds, peak of memory and rows in and out of every stage
+    sink : None, 'log', string or function
+        Where the stages and the run report are sent as they finish, see instrumentation.create_report
+    track_memory : boolean
+        Measure the peak of memory of every stage (tracemalloc slows down the stages)
+    params : dictionary or string
+        Settings of the Poisson model per litter returned by tune_models() (or the path of the
+            JSON file it saved), by default (None) the same settings for all the litters
 
     Returns
     -------
@@ -23,17 +55,104 @@ def train_models(df, litters, aggregation_method='sum'):
         'y_test' : Dataframe with y_test
         'score' : The deviance squared score for the Poisson Model
         'time2train' : Simply the time it took in minutes to fit the model
+    report : dictionary
+        Only with return_report, the run report (see instrumentation.finish_report) with the
+            score and time2train of every litter under 'models'
+    """
+    report = None
+    if return_report or sink is not None:
+        report = instrumentation.create_report('train_models', sink, track_memory)
+    df = instrumentation.run_stage(report, 'clean_df', data_processor.clean_df, df)
+    df = instrumentation.run_stage(report, 'aggregate_df', data_processor.aggregate_df, df, aggregation_method)
+    df = add_features(df, store_dir, report)
+    import helper_scripts.train as train
+    models = instrumentation.run_stage(report, 'make_models', train.make_models, df, litters, params=params)
+    if report is None:
+        return models
+    report = instrumentation.finish_report(report, models={key: {'score': value[2], 'time2train': value[3]}
+                                                           for key, value in models.items()})
+    if return_report:
+        return models, report
+    return models
+
+def tune_models(df, litters, aggregation_method='sum', store_dir=None, output_path='data/params.json', **kwargs):
+    """     Searches the best settings of the ML prediction models with cross validation
+    The result can be passed to train_models() as params. See train.tune_models for the
+        search (kwargs, E.g. alphas, n_splits or n_jobs)
+
+    Parameters
+    ----------
+    df : pandas.dataframe
+        Raw dataframe with the readings for litter counts, the same passed to train_models()
+    litters : list
+        List containig the numerical values of the desired litters to train the ML models
+    output_path : string
+        JSON file where the best settings are saved
+
+    Returns
+    -------
+    params : dictionary
+        Each key correspond to a type of litter, with the best 'alpha' and its 'score'
     """
     df = data_processor.clean_df(df)
     df = data_processor.aggregate_df(df, aggregation_method)
-    df = data_processor.create_date_features(df)
-    df = data_processor.create_coordinates_features(df)
-    df = data_processor.create_weather_features(df)
-    df = data_processor.create_osm_features(df)
-    models = train.make_models(df, litters)
-    return models
+    df = add_features(df, store_dir)
+    import helper_scripts.train as train
+    params = train.tune_models(df, litters, output_path=output_path, **kwargs)
+    return params
+
+def create_update_state(df, models, aggregation_method='sum', store_dir=None):
+    """     Prepares the trained models for daily updates
+    Summarizes the data the models were trained with, computed only once after train_models()
+
+    Parameters
+    ----------
+    df : pandas.dataframe
+        The same dataframe passed to train_models()
+    models : dictionary
+        Dictionary returned using the train_models() function
+
+    Returns
+    -------
+    state : dictionary
+        Dictionary needed by update_models(), store it together with the models
+    """
+    df = data_processor.clean_df(df)
+    df = data_processor.aggregate_df(df, aggregation_method)
+    df = add_features(df, store_dir)
+    import helper_scripts.incremental as incremental
+    state = incremental.create_update_state(models, df)
+    return state
+
+def update_models(df, models, state, aggregation_method='sum', store_dir=None):
+    """     Updates the ML prediction models with new readings, without training them again
+    The time it takes only depends on the size of the new readings. When the new readings have
+        missing features (E.g. a date without weather), a ValueError is raised and the models and
+        the state are left unchanged.
+
+    Parameters
+    ----------
+    df : pandas.dataframe
+        Dataframe with only the new readings for litter counts (E.g. the last day)
+    models : dictionary
+        Dictionary returned using the train_models() function, updated in place
+    state : dictionary
+        Dictionary returned using the create_update_state() function, updated in place
+
+    Returns
+    -------
+    report : dictionary
+        Each key correspond to a type of litter, with the D2 score of the models on the new
+            readings before the update (rolling holdout), see incremental.update_models
+    """
+    df = data_processor.clean_df(df)
+    df = data_processor.aggregate_df(df, aggregation_method)
+    df = add_features(df, store_dir)
+    import helper_scripts.incremental as incremental
+    report = incremental.update_models(models, df, state)
+    return report
 
-def predict_darkzones(df, models):
+def predict_darkzones(df, models, chunk_size=100000, store_dir=None, return_report=False, sink=None, track_memory=True):
     """     Predict the litter counts for the darkzones
     The main purpose of this package, to predict the litter counts for the edges that have no data
         on a given day from the image recognition
@@ -43,27 +162,95 @@ def predict_darkzones(df, models):
     df : pandas.dataframe
         Cleaned and aggegated Dataframe with added features all from data_processor script
     models : dictionary
-        Dictionary returned using the train_models() function
+        Dictionary returned using the train_models() function, or a bundle loaded with bundle.load_models()
+    chunk_size : int
+        Number of darkzone rows predicted at once, keeps the memory bounded
+    store_dir : string
+        Folder of the feature store, by default (None) all the features are computed again
+    return_report : boolean
+        Also return the run report, with the seconds, peak of memory and rows in and out of every stage
+    sink : None, 'log', string or function
+        Where the stages and the run report are sent as they finish, see instrumentation.create_report
+    track_memory : boolean
+        Measure the peak of memory of every stage (tracemalloc slows down the stages)
 
     Returns
     -------
     df : pandas.dataframe
         Dataframe with the same dates as dataframe passed as argument, but with 
-            predicted litters for the missing edges
+            predicted litters for the missing edges. The counts are nullable integers (Int64),
+            null for the rows without features (E.g. dates without weather)
+    report : dictionary
+        Only with return_report, the run report (see instrumentation.finish_report)
     """
-    df = dz_creator.create_darkzones(df)
-    df = data_processor.create_date_features(df)
-    df = data_processor.create_coordinates_features(df)
-    df = data_processor.create_weather_features(df)
-    df = data_processor.create_osm_features(df)
+    report = None
+    if return_report or sink is not None:
+        report = instrumentation.create_report('predict_darkzones', sink, track_memory)
+    df = instrumentation.run_stage(report, 'create_darkzones', dz_creator.create_darkzones, df)
+    df = add_features(df, store_dir, report)
     osm_columns = data_processor.create_osm_columns()
-    for key, model in models.items():
-        predictions = model[0].predict(df)
-        predictions = np.rint(predictions).astype(int)
-        df[f"{key}"] = predictions
+    if bundle.is_bundle(models):
+        predictions = instrumentation.run_stage(report, 'predict', lambda df: bundle.predict(models, df, chunk_size=chunk_size), df)
+        litters = [str(key) for key in models['litters']]
+    else:
+        import helper_scripts.predictor as predictor
+        predictions = instrumentation.run_stage(report, 'predict', predictor.predict_litters, df, models, chunk_size=chunk_size)
+        litters, predictions = [str(key) for key in predictions.columns], predictions.to_numpy()
+    missing = np.isnan(predictions)  #<-- Rows without features (E.g. edges not in the geojson or dates without weather)
+    counts = np.rint(np.where(missing, 0, predictions)).astype(np.int64)
+    for i, key in enumerate(litters):
+        df[key] = pd.arrays.IntegerArray(counts[:, i], missing[:, i])
     columns_to_drop = ['Year', 'month', 'day', 'weekday', 'holiday', 'lat_north', 'lat_south', 'lon_east', 'lon_west', 'edge_length', 
             'temperature_max', 'temperature_min', 'temperature_mean', 'precipitation', 'snowfall', 'humidity_max', 'humidity_min', 
             'humidity_mean', 'cloud_coverage', 'wind_speed_max', 'wind_speed_min', 'wind_speed_mean']
     columns_to_drop.extend(osm_columns)
     df.drop(columns_to_drop, axis=1, inplace=True, errors='ignore')
+    if report is None:
+        return df
+    report = instrumentation.finish_report(report, rows=len(df), dates=int(df['date_utc'].nunique()))
+    if return_report:
+        return df, report
     return df
+
+def predict_darkzones_to_parquet(df, models, out_dir, dates_per_partition=7, n_jobs=-1, store_dir='data/feature_store', chunk_size=100000):
+    """     Predict the litter counts for the darkzones and write them to Parquet, date by date
+    Same predictions as predict_darkzones(), for date ranges too large to keep in memory. The dates
+        are split in partitions of dates_per_partition dates, and each partition is joined with its
+        features, predicted and written by a worker process. Only a few partitions are in flight at
+        once, so the memory stays flat however many dates there are.
+
+    Parameters
+    ----------
+    df : pandas.dataframe
+        Raw dataframe with the readings for litter counts
+    models : dictionary
+        Dictionary returned using the train_models() function, or a bundle loaded with bundle.load_models()
+            (smaller to send to the worker processes)
+    out_dir : string
+        Folder of the Parquet dataset, one 'date_utc=YYYY-MM-DD' folder per date. It can be read
+            back with pandas.read_parquet(out_dir)
+    dates_per_partition : int
+        Number of dates predicted by a worker at once
+    n_jobs : int
+        Number of worker processes, -1 uses all the cores
+    store_dir : string
+        Folder of the feature store, the features of all the edges and dates are stored first
+    chunk_size : int
+        Number of rows predicted and written at once
+
+    Returns
+    -------
+    df_written : pandas.dataframe
+        One row per date with 'date_utc', the number of darkzone 'rows' and the 'path' of its file
+    """
+    from joblib import Parallel, delayed
+    import helper_scripts.partitions as partitions
+    dates, edges_dictionary_extended, observed = dz_creator.index_edges_per_day(df)
+    feature_store.update_edge_features(edges_dictionary_extended['edge_id'], store_dir)
+    feature_store.update_date_features(dates, store_dir)  #<-- The workers only read the store
+    out_dir, store_dir = os.path.abspath(out_dir), os.path.abspath(store_dir)  #<-- Workers can run in another folder
+    written = Parallel(n_jobs=n_jobs, max_nbytes='1M', mmap_mode='r', pre_dispatch='2*n_jobs')(
+        delayed(partitions.predict_partition)(dates, edges_dictionary_extended, observed, first_date, last_date,
+                                              models, out_dir, store_dir, chunk_size)
+        for first_date, last_date in partitions.partition_dates(len(dates), dates_per_partition))
+    return pd.DataFrame([row for rows in written for row in rows], columns=['date_utc', 'rows', 'path'])
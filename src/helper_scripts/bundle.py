@@ -0,0 +1,109 @@
+import numpy as np
+
+# Only numpy is imported here, so a prediction worker can load and score a bundle without
+#   importing pandas, sklearn, osmnx or holidays
+
+def export_models(models, file_path):
+    """     Stores the models dictionary as a compact binary bundle (numpy .npz file)
+    For each group of litters sharing a preprocessor, the bundle contains the names of the numeric
+        columns with the centers and scales of the RobustScaler, the names of the categorical columns
+        with the categories of the OneHotEncoder, and the coefficients of all the Poisson models of
+        the group stacked in one matrix.
+
+    Parameters
+    ----------
+    models : dictionary
+        Dictionary returned using the train_models() function
+    file_path : string
+        Path of the bundle, E.g. 'models.npz'
+    """
+    import helper_scripts.predictor as predictor
+    arrays = {'litters': np.array(list(models.keys()), dtype=str),
+              'labels': np.array([value[4] if len(value) > 4 else '' for value in models.values()], dtype=str),
+              'scores': np.array([value[2] for value in models.values()], dtype=np.float64)}
+    groups = predictor.group_models(models)
+    arrays['n_groups'] = np.array(len(groups))
+    for g, (preprocessor, keys) in enumerate(groups):
+        columns = {name: (transformer, list(features)) for name, transformer, features in preprocessor.transformers_}
+        scaler = columns['num'][0].named_steps['scaler']
+        encoder = columns['cat'][0].named_steps['onehot']
+        n_numeric = len(columns['num'][1])
+        arrays[f"g{g}_numeric_columns"] = np.array(columns['num'][1], dtype=str)
+        arrays[f"g{g}_center"] = np.zeros(n_numeric) if scaler.center_ is None else np.asarray(scaler.center_, dtype=np.float64)
+        arrays[f"g{g}_scale"] = np.ones(n_numeric) if scaler.scale_ is None else np.asarray(scaler.scale_, dtype=np.float64)
+        arrays[f"g{g}_cat_columns"] = np.array(columns['cat'][1], dtype=str)
+        for j, categories in enumerate(encoder.categories_):
+            arrays[f"g{g}_cat{j}_levels"] = np.array([str(category) for category in categories], dtype=str)
+        coef, intercept = predictor.stack_coefficients(models, keys)
+        arrays[f"g{g}_coef"] = coef
+        arrays[f"g{g}_intercept"] = intercept
+        arrays[f"g{g}_litters"] = np.array(keys, dtype=str)
+    np.savez(file_path, **arrays)
+
+def load_models(file_path):
+    """     Loads a bundle stored with export_models
+    Returns a dictionary of numpy arrays, to be used with predict()
+    """
+    with np.load(file_path, allow_pickle=False) as data:
+        bundle = {key: data[key] for key in data.files}
+    bundle['is_bundle'] = True
+    return bundle
+
+def is_bundle(models):
+    """     True when models was loaded with load_models, False for the models dictionary of train_models()
+    """
+    return isinstance(models, dict) and models.get('is_bundle') is True
+
+def predict(bundle, df, chunk_size=100000):
+    """     Predicts all the litters from a bundle, using only numpy
+    Same predictions as the sklearn pipelines: the numeric columns are scaled with the stored
+        centers and scales, the categorical columns are looked up in the stored categories
+        (unknown categories are ignored, as with handle_unknown="ignore"), and the predicted counts
+        are exp(X @ coef + intercept).
+
+    Parameters
+    ----------
+    bundle : dictionary
+        Bundle returned using the load_models() function
+    df : pandas.dataframe
+        Dataframe (or dictionary of arrays) with the feature columns used to train the models
+    chunk_size : int
+        Number of rows predicted at once, keeps the memory bounded. None uses all the rows
+
+    Returns
+    -------
+    predictions : numpy.array
+        Array with one row per row of df and one column per litter, in the order of bundle['litters']
+    """
+    litters = list(bundle['litters'])
+    columns = set(str(column) for g in range(int(bundle['n_groups']))
+                  for column in np.concatenate([bundle[f"g{g}_numeric_columns"], bundle[f"g{g}_cat_columns"]]))
+    data = {column: np.asarray(df[column]) for column in columns}  #<-- No copy for pandas columns
+    n_rows = len(next(iter(data.values()))) if data else 0
+    predictions = np.empty((n_rows, len(litters)))
+    chunk_size = chunk_size or max(n_rows, 1)
+    for g in range(int(bundle['n_groups'])):
+        coef = bundle[f"g{g}_coef"]
+        positions = [litters.index(key) for key in bundle[f"g{g}_litters"]]
+        numeric_columns = [str(column) for column in bundle[f"g{g}_numeric_columns"]]
+        n_numeric = len(numeric_columns)
+        lookups = []
+        offset = n_numeric
+        for j, column in enumerate(bundle[f"g{g}_cat_columns"]):
+            levels = bundle[f"g{g}_cat{j}_levels"]
+            lookups.append((str(column), {level: offset + i for i, level in enumerate(levels)}))
+            offset += len(levels)
+        for start in range(0, n_rows, chunk_size):
+            stop = min(start + chunk_size, n_rows)
+            eta = np.tile(bundle[f"g{g}_intercept"], (stop - start, 1))
+            if n_numeric:
+                X = np.column_stack([data[column][start:stop].astype(np.float64) for column in numeric_columns])
+                eta += ((X - bundle[f"g{g}_center"]) / bundle[f"g{g}_scale"]) @ coef[:n_numeric]
+            for column, lookup in lookups:
+                values = data[column][start:stop].astype(str)
+                uniques, inverse = np.unique(values, return_inverse=True)
+                rows = np.array([lookup.get(value, -1) for value in uniques], dtype=np.int64)[inverse]
+                known = rows >= 0
+                eta[known] += coef[rows[known]]
+            predictions[start:stop, positions] = np.exp(eta)
+    return predictions
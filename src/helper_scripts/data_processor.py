@@ -1,12 +1,11 @@
 import pandas as pd
 import numpy as np
 from datetime import timedelta
+from functools import lru_cache
 import json, urllib.request
 from math import atan, cos, radians, sin, tan, asin, sqrt
-import warnings
-from shapely.errors import ShapelyDeprecationWarning
-from holidays import Switzerland
-import osmnx as ox
+import helper_scripts.osm_cache as osm_cache
+import helper_scripts.edges_index as edges_index
 
 def get_litter_columns(df):
     """     Get litter columns from dataframe.
@@ -64,31 +63,62 @@ def aggregate_df(df, aggregation_method='sum'):
     df = df.groupby(['date_utc', 'edge_id'], as_index=False).agg(to_agg)
     return df
 
+@lru_cache(maxsize=None)
+def create_holidays_table(first_year, last_year):
+    """     Swiss holidays and the day following each holiday, for all the years between first_year and last_year
+    Returns a sorted numpy array of dates, computed once per range of years
+    """
+    from holidays import Switzerland
+    holiday = [day for day in Switzerland(years=range(first_year, last_year + 1)).keys()]
+    holiday_days = set(holiday)
+    for day in holiday:
+        holiday_days.add(day + timedelta(days=1))
+    return np.array(sorted(holiday_days), dtype='datetime64[D]')
+
 def create_date_features(df):
     """     Adds date features for model training
     Separates the date into day, month and year columns.
     Add days of the week as a categorical feature.
     Marks the day and following day after a holiday as a boolean.
+    The features are computed once per unique date and then broadcast to the rows,
+        the holidays cover all the years present in the data.
     """
-    df['Year'] = pd.DatetimeIndex(df['date_utc']).year.astype(object)
-    df['month'] = pd.DatetimeIndex(df['date_utc']).month.astype(object)
-    df['day'] = pd.DatetimeIndex(df['date_utc']).day.astype(object)
-    weekdays = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
-    df['weekday'] = pd.to_datetime(df['date_utc']).dt.date.apply(lambda x: x.weekday())
-    df['weekday'] = df['weekday'].apply(lambda x: weekdays[x])
-    holiday = [holiday for holiday in Switzerland(years=[2021, 2022]).items()]
-    for day in set(holiday):
-        holiday.append(((day[0] + timedelta(days=1)), day[1]))
-    holidays_df = pd.DataFrame(holiday, columns=["date", "holiday"])
-    holidays_df['holiday'] = holidays_df['holiday'].astype(str)
-    df['holiday'] = df['date_utc'].apply(lambda x: 1 if x in holidays_df['date'].values else 0)
+    codes, dates = pd.factorize(df['date_utc'])
+    dates = pd.DatetimeIndex(pd.to_datetime(dates))
+    weekdays = np.array(('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'), dtype=object)
+    if len(dates) > 0:
+        holidays_table = create_holidays_table(int(dates.year.min()) - 1, int(dates.year.max()))  #<-- Year before, for the day after New Year's Eve
+    else:
+        holidays_table = np.array([], dtype='datetime64[D]')
+    calendar = {'Year': np.asarray(dates.year.astype(object)),
+                'month': np.asarray(dates.month.astype(object)),
+                'day': np.asarray(dates.day.astype(object)),
+                'weekday': weekdays[np.asarray(dates.weekday)],
+                'holiday': np.isin(dates.values.astype('datetime64[D]'), holidays_table).astype(np.int64)}
+    missing = {'Year': np.nan, 'month': np.nan, 'day': np.nan, 'weekday': np.nan, 'holiday': 0}
+    for column, values in calendar.items():
+        df[column] = np.append(values, missing[column])[codes]  #<-- Code -1 (missing date) takes the last value
     return df
 
-def create_coordinates_features(df, file_path='data/edges.geojson'):
+def create_coordinates_features(df, file_path='data/edges.geojson', index_path='data/edges_index'):
     """     Adds columns with bounding box coordinates for the corresponding edge_id
     Using the edges.geojson file, adds the coordinates that create a bounding box for each edge_id.
     Also adds the length of the edge as a feature
+    When the compiled index of edges_index exists, the coordinates are looked up there instead of
+        parsing the geojson file (compile it with: python -m helper_scripts.edges_index)
     """
+    index = edges_index.load_edges_index(index_path, file_path)
+    if index is not None:
+        edge_ids, bbox, edge_length = index
+        codes, uniques = pd.factorize(df['edge_id'])
+        rows = edges_index.lookup_rows(edge_ids, uniques)
+        rows = np.append(rows, -1)[codes]  #<-- Code -1 (missing edge_id) also gets row -1
+        found = rows >= 0
+        df = df.reset_index(drop=True)
+        df['edge_length'] = np.where(found, edge_length[rows], np.nan)
+        for i, column in enumerate(['lat_north', 'lat_south', 'lon_east', 'lon_west']):
+            df[column] = np.where(found, bbox[rows, i], np.nan)
+        return df
     with open(file_path) as file:
         data = json.load(file)
     df_edges = pd.DataFrame(data['features'])  # <-- The only column needed from geojson file
@@ -138,44 +168,96 @@ def create_osm_columns():
     osm_columns = sorted(osm_tags)
     return osm_columns
 
-def create_osm_features(df):
+def match_amenities_to_edges(df_edges_coordinates, df_osm, buffer_meters=0, batch_size=10000):
+    """     Spatial join between the edge bounding boxes and the amenity points
+    The amenities are sorted by latitude once, so each bounding box only has to look at the
+    strip of amenities between its south and north latitude (found with a binary search).
+    The remaining longitude check is done in vectorized batches of edges.
+    An amenity is matched when it lies strictly inside the bounding box, same as the
+    original nested loop, so the per edge counts are identical.
+
+    Parameters
+    ----------
+    df_edges_coordinates : pandas.dataframe
+        Dataframe with the columns 'edge_id', 'lat_north', 'lat_south', 'lon_east', 'lon_west'
+    df_osm : pandas.dataframe
+        Dataframe with the columns 'amenity', 'lat', 'lon'
+    buffer_meters : float
+        Grow each bounding box by this many meters on every side, so an edge also
+        picks up the amenities that are close to it. 0 keeps the exact bounding box
+    batch_size : int
+        Number of edges that are matched at once, bounds the memory of the join
+
+    Returns
+    -------
+    df_edges_dict : pandas.dataframe
+        Dataframe with one row per matched pair, columns 'edge_id' and 'amenity'
+    """
+    osm_lat = df_osm['lat'].to_numpy(dtype=float)
+    order = np.argsort(osm_lat, kind='stable')
+    osm_lat = osm_lat[order]
+    osm_lon = df_osm['lon'].to_numpy(dtype=float)[order]
+    osm_amenity = df_osm['amenity'].to_numpy()[order]
+
+    edge_ids = df_edges_coordinates['edge_id'].to_numpy()
+    lat_a = df_edges_coordinates['lat_south'].to_numpy(dtype=float)
+    lat_b = df_edges_coordinates['lat_north'].to_numpy(dtype=float)
+    lon_a = df_edges_coordinates['lon_west'].to_numpy(dtype=float)
+    lon_b = df_edges_coordinates['lon_east'].to_numpy(dtype=float)
+    lat_min, lat_max = np.minimum(lat_a, lat_b), np.maximum(lat_a, lat_b)
+    lon_min, lon_max = np.minimum(lon_a, lon_b), np.maximum(lon_a, lon_b)
+    if buffer_meters > 0:
+        buffer_lat = buffer_meters / 111320  #<-- Meters per degree of latitude
+        buffer_lon = buffer_meters / (111320 * np.cos(np.radians((lat_min + lat_max) / 2)))
+        lat_min, lat_max = lat_min - buffer_lat, lat_max + buffer_lat
+        lon_min, lon_max = lon_min - buffer_lon, lon_max + buffer_lon
+
+    matched_edges = []
+    matched_amenities = []
+    for start in range(0, len(edge_ids), batch_size):
+        batch = slice(start, start + batch_size)
+        valid = ~(np.isnan(lat_min[batch]) | np.isnan(lat_max[batch]))  #<-- Edges without coordinates match nothing
+        first = np.searchsorted(osm_lat, lat_min[batch], side='right')
+        last = np.searchsorted(osm_lat, lat_max[batch], side='left')
+        counts = np.where(valid, np.maximum(last - first, 0), 0)
+        if counts.sum() == 0:
+            continue
+        # Expand every edge into its candidate amenities (the ones inside its latitude strip)
+        edge_position = np.repeat(np.arange(start, start + len(counts)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        candidate = np.repeat(first, counts) + offsets
+        inside = (lon_min[edge_position] < osm_lon[candidate]) & (osm_lon[candidate] < lon_max[edge_position])
+        matched_edges.append(edge_ids[edge_position[inside]])
+        matched_amenities.append(osm_amenity[candidate[inside]])
+
+    if matched_edges:
+        df_edges_dict = pd.DataFrame({'edge_id': np.concatenate(matched_edges), 'amenity': np.concatenate(matched_amenities)})
+    else:
+        df_edges_dict = pd.DataFrame(columns=['edge_id', 'amenity'])
+    return df_edges_dict
+
+def create_osm_features(df, place='Basel, Basel, Switzerland', buffer_meters=0, cache_dir='data/osm_cache', ttl_days=30, offline=False):
     """     Adds number of amenities located at the edge
     Based on the tags dictionary, adds a count of the amount of amenities present in each edge
-    Obtains data from Open Street Maps using the OSMNX library
+    Obtains data from Open Street Maps using the OSMNX library, through the local cache in osm_cache,
+        so the amenities are only downloaded when the cache is empty or older than ttl_days
+    With buffer_meters > 0, also counts the amenities within that distance of the edge's bounding box
+    Always adds one column per amenity of create_osm_columns, 0 when no edge of df has it, so any
+        subset of the edges (E.g. a single day) gets the same columns the models were trained with
     """
-    warnings.filterwarnings("ignore", category=ShapelyDeprecationWarning) 
-    basel = 'Basel, Basel, Switzerland'
-    tags = {'amenity': sorted(create_osm_columns())}
-    amenity = ox.geometries_from_place(basel, tags=tags)
-    df_osm = pd.DataFrame(amenity)
-    df_osm = df_osm[['amenity', 'geometry']].copy()  #<-- Select the only needed columns
-    df_osm['osm_id'] = df_osm.index.to_numpy()  #<-- Detach the index and assign it to a normal column
-    df_osm.reset_index(drop=True, inplace=True)  #<-- Drop index
-    osm_id_exploded = pd.DataFrame(df_osm["osm_id"].to_list(), columns=['type', 'osm'])  #<-- Explode index since it contains two indices
-    df_osm = pd.concat([df_osm, osm_id_exploded], axis=1) 
-    df_osm.drop(['osm_id', 'osm'], axis=1, inplace=True)
-    df_osm = df_osm[df_osm['type'] == 'node']  #<-- Drop Multipoligon points
-    #### Clean the coordinates from the GeoPandas geometry format to latitude and longitude columns
-    df_osm['lon'] = df_osm[df_osm['type'] == "node"]['geometry'].apply(lambda p: p.x)
-    df_osm['lat'] = df_osm[df_osm['type'] == "node"]['geometry'].apply(lambda p: p.y)
-    df_osm.drop(['geometry', 'type'], axis=1, inplace=True)
+    osm_columns = create_osm_columns()
+    tags = {'amenity': sorted(osm_columns)}
+    df_osm = osm_cache.load_amenities(place, tags, cache_dir=cache_dir, ttl_days=ttl_days, offline=offline)
     df_edges_coordinates = df[['edge_id', 'lat_north', 'lat_south', 'lon_east', 'lon_west']].copy()
     df_edges_coordinates = df_edges_coordinates.drop_duplicates(subset='edge_id', keep='first')
 
     # Make a list of the edges that have an amenity to them based on lat,lon conditional
-    def is_between(a, x, b):
-        return min(a, b) < x < max(a, b)
-    edges_dict = []
-    for edges_row in df_edges_coordinates.itertuples():
-        for osm_row in df_osm.itertuples():
-            if is_between(edges_row.lat_south, osm_row.lat, edges_row.lat_north) and is_between(edges_row.lon_west, osm_row.lon, edges_row.lon_east):
-                edges_dict.append([edges_row.edge_id, osm_row.amenity])
+    df_edges_dict = match_amenities_to_edges(df_edges_coordinates, df_osm, buffer_meters=buffer_meters)
 
     # Group by edge_id and get the value counts per amenity
-    df_edges_dict = pd.DataFrame(edges_dict, columns = ['edge_id', 'amenity'])
-    df_edges_dict = df_edges_dict.groupby('edge_id')['amenity'].value_counts().unstack(fill_value=0).reset_index()
+    df_edges_dict = df_edges_dict.groupby('edge_id')['amenity'].value_counts().unstack(fill_value=0)
+    df_edges_dict = df_edges_dict.reindex(columns=osm_columns, fill_value=0).reset_index()
     df = pd.merge(df, df_edges_dict, how="left", on="edge_id")
-    osm_columns = list(df_edges_dict.columns[1:])
     df[osm_columns] = df[osm_columns].fillna(value=0)  #<-- Fill missing values, since not all edges have amenities
     df[osm_columns] = df[osm_columns].astype(int)
-    return df
\ No newline at end of file
+    return df
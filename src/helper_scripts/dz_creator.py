@@ -1,5 +1,51 @@
 import helper_scripts.data_processor as data_processor
 import pandas as pd
+import numpy as np
+
+def index_edges_per_day(df):
+    """     Integer codes of the edges present during each day
+    Cleans the dataframe passed as an argument and encodes every unique date and edge_id as an integer
+        (both sorted), so each (date, edge_id) pair present in the data becomes a single integer:
+        date_code * number_of_edges + edge_code
+
+    Parameters
+    ----------
+    df : pandas.dataframe
+        Raw dataframe with the readings for litter counts
+
+    Returns
+    -------
+    dates : numpy.array
+        The unique dates, sorted
+    edges_dictionary_extended : pandas.dataframe
+        The unique edges, sorted by edge_id, with the columns 'edge_id', 'edge_osmid' and 'osm_highway'
+    observed : numpy.array
+        Sorted codes of the (date, edge_id) pairs present in the data
+    """
+    df = data_processor.clean_df(df)
+    df = df.groupby(['date_utc', 'edge_id'], as_index=False).agg({'edge_osmid':'first', 'osm_highway':'first'})
+    date_codes, dates = pd.factorize(df['date_utc'], sort=True)
+    edge_codes, edges = pd.factorize(df['edge_id'], sort=True)
+    edges_dictionary_extended = df.groupby(['edge_id'], as_index=False).agg({'edge_osmid':'first', 'osm_highway':'first'})
+    observed = np.sort(date_codes.astype(np.int64) * len(edges) + edge_codes)
+    return np.asarray(dates), edges_dictionary_extended, observed
+
+def darkzones_between(dates, edges_dictionary_extended, observed, first_date, last_date):
+    """     Darkzones of the dates with a code from first_date up to (not including) last_date
+    Builds the date x edge grid for those dates as a boolean mask, marks the observed pairs
+        and keeps the ones that were not observed (anti-join)
+    """
+    n_edges = len(edges_dictionary_extended)
+    offset = first_date * n_edges
+    seen = np.zeros((last_date - first_date) * n_edges, dtype=bool)
+    start, stop = np.searchsorted(observed, [offset, last_date * n_edges])
+    seen[observed[start:stop] - offset] = True
+    missing = np.flatnonzero(~seen)
+    df_darkzones = edges_dictionary_extended.iloc[missing % n_edges].reset_index(drop=True)
+    df_darkzones.insert(0, 'date_utc', dates[missing // n_edges + first_date])
+    df_darkzones['row_type'] = "darkzone"
+    df_darkzones['edge_osmid'] = df_darkzones['edge_osmid'].astype(int)
+    return df_darkzones
 
 def create_darkzones(df):
     """     Creates a dataframe with the edges not present during each day
@@ -7,42 +53,27 @@ def create_darkzones(df):
     Based on the dataframe passed as an argument, it will create a dictionary of the unique edge_ids present.
     Using this dictionary, it will add edge_ids not present on each individual day to the returned dataframe
     """
-    litter_columns = data_processor.get_litter_columns(df)
-    df = data_processor.clean_df(df)
-    df = data_processor.aggregate_df(df)
-    df.drop('total_litter', axis=1, inplace=True, errors='ignore')
-    df.drop(litter_columns, axis=1, inplace=True, errors='ignore')
-    df['date_utc'] = df['date_utc'].astype(str)
-
-    edges_dictionary = df['edge_id'].unique()
-    # Make a dictionary with the date as key and the edges existing within that day in a list as their value
-    today = ''
-    existing_edges = {}
-    for index, row in df.iterrows():
-        if row['date_utc'] != today:
-            today = row['date_utc']
-            existing_edges[today] = []
-        if row['edge_id'] not in existing_edges[today]:
-            existing_edges[today].append(row['edge_id'])
-
-    # Compare the existing edges in a day with the list of all the unique edges, 
-    #   add the edges not in a day in a dictionary, 
-    #   where the key is the date and the value is a list of the missing edges in that dataframe
-    missing_edges = {}
-    for key, value in existing_edges.items():
-        missing_edges[key] = list(set(edges_dictionary).difference(value))
-    missing_edges_list = []
-    for key, value in missing_edges.items():
-        for v in value:
-            missing_edges_list.append([key, v])
-
-    df_darkzones = pd.DataFrame(list(missing_edges_list), columns = ['date_utc', 'edge_id']) 
-    edges_dictionary_extended = df.groupby(['edge_id'], as_index=False).agg({'edge_osmid':'first', 'osm_highway':'first'})
-    df_darkzones = pd.merge(df_darkzones, edges_dictionary_extended, how='outer', on='edge_id')
-    #df_darkzones['date_utc'] = pd.to_datetime(df_darkzones['date_utc'], format='%Y-%m-%d') Maybe delete
-    df_darkzones['date_utc'] = pd.to_datetime(df_darkzones['date_utc']).dt.date
-    df_darkzones = df_darkzones.sort_values(by="date_utc")
-    df_darkzones = df_darkzones.reset_index(drop=True)
-    df_darkzones['row_type'] = "darkzone"
-    df_darkzones['edge_osmid'] = df_darkzones['edge_osmid'].astype(int)
-    return df_darkzones
\ No newline at end of file
+    dates, edges_dictionary_extended, observed = index_edges_per_day(df)
+    df_darkzones = darkzones_between(dates, edges_dictionary_extended, observed, 0, len(dates))
+    return df_darkzones
+
+def iter_darkzones(df, dates_per_chunk=1):
+    """     Same as create_darkzones, but yields the darkzones a few dates at a time
+    Only the date x edge grid of the current chunk is kept in memory.
+
+    Parameters
+    ----------
+    df : pandas.dataframe
+        Raw dataframe with the readings for litter counts
+    dates_per_chunk : int
+        Number of dates in each yielded dataframe
+
+    Yields
+    ------
+    df_darkzones : pandas.dataframe
+        Darkzones of the next dates_per_chunk dates, same columns as create_darkzones
+    """
+    dates, edges_dictionary_extended, observed = index_edges_per_day(df)
+    for first_date in range(0, len(dates), dates_per_chunk):
+        last_date = min(first_date + dates_per_chunk, len(dates))
+        yield darkzones_between(dates, edges_dictionary_extended, observed, first_date, last_date)
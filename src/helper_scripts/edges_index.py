@@ -0,0 +1,89 @@
+import numpy as np
+import json, os
+import argparse
+import warnings
+
+def source_fingerprint(file_path):
+    """     Size and modification time of the geojson file the index was compiled from
+    """
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def compile_edges_index(file_path='data/edges.geojson', index_path='data/edges_index'):
+    """     Compiles the edges geojson file into a memory mappable index
+    Parses the geojson once and stores in the index_path folder:
+        'edge_id.npy' : The edge_ids, sorted, so a row is found with a binary search
+        'bbox.npy' : Float array with the columns lat_north, lat_south, lon_east, lon_west
+        'edge_length.npy' : Float array with the length of the edge
+        'meta.json' : Size and modification time of the geojson file, to detect an outdated index
+    When an edge_id is repeated, the first one is kept, same as a merge with the first match.
+
+    Returns
+    -------
+    n_edges : int
+        Number of edges in the index
+    """
+    with open(file_path) as file:
+        data = json.load(file)
+    features = data['features']
+    edge_ids = np.array([str(feature['id']) for feature in features])
+    bbox = np.array([feature['bbox'] for feature in features], dtype=np.float64).reshape(-1, 4)
+    length = np.array([feature['properties']['length'] for feature in features], dtype=np.float64)
+    edge_ids, first = np.unique(edge_ids, return_index=True)  #<-- Sorted, first occurrence of repeated ids
+    bbox = bbox[first]
+    # Rearrange BBOX (lat_north, lat_south, lon_east, lon_west)
+    bbox = np.column_stack([np.maximum(bbox[:, 1], bbox[:, 3]), np.minimum(bbox[:, 1], bbox[:, 3]),
+                            np.maximum(bbox[:, 0], bbox[:, 2]), np.minimum(bbox[:, 0], bbox[:, 2])])
+    os.makedirs(index_path, exist_ok=True)
+    np.save(os.path.join(index_path, 'edge_id.npy'), edge_ids)
+    np.save(os.path.join(index_path, 'bbox.npy'), np.ascontiguousarray(bbox))
+    np.save(os.path.join(index_path, 'edge_length.npy'), length[first])
+    with open(os.path.join(index_path, 'meta.json'), 'w') as file:
+        json.dump({'source': file_path, 'source_fingerprint': source_fingerprint(file_path), 'edges': len(edge_ids)}, file)
+    return len(edge_ids)
+
+def load_edges_index(index_path='data/edges_index', file_path='data/edges.geojson'):
+    """     Opens the compiled index as memory mapped arrays
+    Returns None when there is no index, or when it is older than the geojson file it was compiled from.
+
+    Returns
+    -------
+    edge_ids : numpy.array
+        Sorted edge_ids
+    bbox : numpy.array
+        Array with the columns lat_north, lat_south, lon_east, lon_west
+    edge_length : numpy.array
+        Length of the edges
+    """
+    meta_path = os.path.join(index_path, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as file:
+        meta = json.load(file)
+    if os.path.exists(file_path) and meta['source_fingerprint'] != source_fingerprint(file_path):
+        warnings.warn(f"The edges index in '{index_path}' is older than '{file_path}', using the geojson file. "
+                      "Compile it again with: python -m helper_scripts.edges_index")
+        return None
+    edge_ids = np.load(os.path.join(index_path, 'edge_id.npy'), mmap_mode='r')
+    bbox = np.load(os.path.join(index_path, 'bbox.npy'), mmap_mode='r')
+    edge_length = np.load(os.path.join(index_path, 'edge_length.npy'), mmap_mode='r')
+    return edge_ids, bbox, edge_length
+
+def lookup_rows(edge_ids, values):
+    """     Row of each value in the sorted edge_ids, -1 when the edge is not in the index
+    """
+    values = np.asarray(values, dtype=str)
+    if len(edge_ids) == 0:
+        return np.full(len(values), -1)
+    rows = np.searchsorted(edge_ids, values)
+    rows = np.minimum(rows, len(edge_ids) - 1)
+    return np.where(edge_ids[rows] == values, rows, -1)
+
+if __name__ == '__main__':
+    # Run from the src folder, E.g.: python -m helper_scripts.edges_index
+    parser = argparse.ArgumentParser(description='Compile the edges geojson file into a memory mappable index')
+    parser.add_argument('--file', default='data/edges.geojson')
+    parser.add_argument('--index', default='data/edges_index')
+    args = parser.parse_args()
+    n_edges = compile_edges_index(args.file, args.index)
+    print(f"Compiled {n_edges} edges from {args.file} into {args.index}")
@@ -0,0 +1,177 @@
+import helper_scripts.data_processor as data_processor
+import helper_scripts.osm_cache as osm_cache
+import pandas as pd
+import hashlib, json, os, glob, shutil
+
+STORE_VERSION = 1  #<-- Increase when the way a feature is computed changes, the store is then rebuilt
+CALENDAR_COLUMNS = ['Year', 'month', 'day', 'weekday', 'holiday']
+COORDINATES_COLUMNS = ['edge_length', 'lat_north', 'lat_south', 'lon_east', 'lon_west']
+
+def file_fingerprint(file_path):
+    """     Cheap fingerprint of a file, its size and modification time
+    """
+    if not os.path.exists(file_path):
+        return None
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def edges_fingerprint(edges_path, place, buffer_meters, cache_dir):
+    """     Fingerprint of everything the edge features depend on
+    The geojson file, the place and buffer of the OSM features, the cached amenities and the store version
+    """
+    tags = {'amenity': sorted(data_processor.create_osm_columns())}
+    osm_path, _ = osm_cache.cache_paths(place, tags, cache_dir)
+    fingerprint = {'version': STORE_VERSION, 'edges': file_fingerprint(edges_path), 'place': place,
+                   'buffer_meters': buffer_meters, 'tags': tags, 'osm': file_fingerprint(osm_path)}
+    return hashlib.sha1(json.dumps(fingerprint, sort_keys=True).encode('utf-8')).hexdigest()
+
+def dates_fingerprint(weather_path):
+    """     Fingerprint of everything the date features depend on
+    Only the name of the weather file is used and not its content, since the file grows with
+        every new day. Dates stored without weather are computed again (see update_date_features).
+    """
+    fingerprint = {'version': STORE_VERSION, 'weather': os.path.basename(weather_path)}
+    return hashlib.sha1(json.dumps(fingerprint, sort_keys=True).encode('utf-8')).hexdigest()
+
+def read_manifest(store_dir):
+    manifest_path = os.path.join(store_dir, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as file:
+        return json.load(file)
+
+def write_manifest(store_dir, manifest):
+    os.makedirs(store_dir, exist_ok=True)
+    with open(os.path.join(store_dir, 'manifest.json'), 'w') as file:
+        json.dump(manifest, file, indent=4)
+
+def load_edge_features(store_dir='data/feature_store'):
+    """     Reads the stored edge features
+    Returns a dataframe with one row per edge_id with the coordinates and the amenity counts, one
+        column per amenity of create_osm_columns, the same columns as create_osm_features
+    """
+    osm_columns = data_processor.create_osm_columns()
+    parts = sorted(glob.glob(os.path.join(store_dir, 'edges', 'part-*.parquet')))
+    if not parts:
+        return pd.DataFrame(columns=['edge_id'] + COORDINATES_COLUMNS + osm_columns)
+    df_edges = pd.concat([pd.read_parquet(part) for part in parts], ignore_index=True)
+    df_edges = df_edges.reindex(columns=['edge_id'] + COORDINATES_COLUMNS + osm_columns)
+    df_edges[osm_columns] = df_edges[osm_columns].fillna(value=0).astype(int)  #<-- Older parts only have the amenities of their edges
+    return df_edges
+
+def load_date_features(store_dir='data/feature_store'):
+    """     Reads the stored date features
+    Returns a dataframe with one row per date with the calendar and weather features
+    """
+    partitions = sorted(glob.glob(os.path.join(store_dir, 'dates', 'month=*.parquet')))
+    if not partitions:
+        return pd.DataFrame(columns=['date_utc'] + CALENDAR_COLUMNS)
+    df_dates = pd.concat([pd.read_parquet(partition) for partition in partitions], ignore_index=True)
+    df_dates[['Year', 'month', 'day']] = df_dates[['Year', 'month', 'day']].astype(object)  #<-- Categorical features, as in create_date_features
+    return df_dates
+
+def update_edge_features(edge_ids, store_dir='data/feature_store', edges_path='data/edges.geojson',
+                         place='Basel, Basel, Switzerland', buffer_meters=0, cache_dir='data/osm_cache'):
+    """     Adds the features of the edges that are not in the store yet
+    The new edges are written as a new part, so the cost only depends on the number of new edges.
+    If the geojson file, the OSM settings or the cached amenities changed, the edge features are built again.
+    """
+    manifest = read_manifest(store_dir)
+    edges_dir = os.path.join(store_dir, 'edges')
+    if manifest.get('edges_fingerprint') != edges_fingerprint(edges_path, place, buffer_meters, cache_dir):
+        shutil.rmtree(edges_dir, ignore_errors=True)
+    os.makedirs(edges_dir, exist_ok=True)
+    stored_edges = load_edge_features(store_dir)['edge_id']
+    new_edges = pd.Index(pd.unique(pd.Series(edge_ids).dropna())).difference(stored_edges)
+    if len(new_edges) > 0:
+        tags = {'amenity': sorted(data_processor.create_osm_columns())}
+        osm_cache.load_amenities(place, tags, cache_dir=cache_dir)  #<-- Can download the amenities again (TTL of the cache)
+        if len(stored_edges) > 0 and manifest.get('edges_fingerprint') != edges_fingerprint(edges_path, place, buffer_meters, cache_dir):
+            shutil.rmtree(edges_dir, ignore_errors=True)  #<-- New amenities, the stored counts are outdated
+            os.makedirs(edges_dir, exist_ok=True)
+            new_edges = new_edges.union(stored_edges)
+        df_edges = pd.DataFrame({'edge_id': new_edges})
+        df_edges = data_processor.create_coordinates_features(df_edges, edges_path)
+        df_edges = data_processor.create_osm_features(df_edges, place=place, buffer_meters=buffer_meters, cache_dir=cache_dir)
+        part = len(glob.glob(os.path.join(edges_dir, 'part-*.parquet')))
+        df_edges.to_parquet(os.path.join(edges_dir, f"part-{part:05d}.parquet"), index=False)
+    manifest = read_manifest(store_dir)
+    manifest['version'] = STORE_VERSION
+    manifest['edges_fingerprint'] = edges_fingerprint(edges_path, place, buffer_meters, cache_dir)
+    write_manifest(store_dir, manifest)
+    return len(new_edges)
+
+def update_date_features(dates, store_dir='data/feature_store', weather_path='data/weather_basel_2021-2022.csv'):
+    """     Adds the features of the dates that are not in the store yet
+    Dates are partitioned by month, so only the months of the new dates are written again.
+    Dates that were stored without weather (not in the weather file at that time) are computed again.
+    """
+    manifest = read_manifest(store_dir)
+    dates_dir = os.path.join(store_dir, 'dates')
+    if manifest.get('dates_fingerprint') != dates_fingerprint(weather_path):
+        shutil.rmtree(dates_dir, ignore_errors=True)
+    os.makedirs(dates_dir, exist_ok=True)
+    df_stored = load_date_features(store_dir)
+    weather_columns = [column for column in df_stored.columns if column not in ['date_utc'] + CALENDAR_COLUMNS]
+    if weather_columns:
+        df_stored = df_stored[df_stored[weather_columns].notna().any(axis=1)]
+    dates = pd.Series(pd.to_datetime(pd.Series(dates).dropna().unique()).date)
+    new_dates = dates[~dates.isin(df_stored['date_utc'])]
+    if len(new_dates) > 0:
+        df_dates = pd.DataFrame({'date_utc': new_dates.to_numpy()})
+        df_dates = data_processor.create_date_features(df_dates)
+        df_dates = data_processor.create_weather_features(df_dates, weather_path)
+        months = pd.to_datetime(df_dates['date_utc']).dt.strftime('%Y-%m')
+        for month, df_month in df_dates.groupby(months):
+            partition = os.path.join(dates_dir, f"month={month}.parquet")
+            if os.path.exists(partition):
+                df_month = pd.concat([pd.read_parquet(partition), df_month], ignore_index=True)
+                df_month = df_month.drop_duplicates(subset='date_utc', keep='last')
+            df_month = df_month.sort_values(by='date_utc')
+            df_month[['Year', 'month', 'day']] = df_month[['Year', 'month', 'day']].astype(int)
+            df_month.to_parquet(partition, index=False)
+    manifest = read_manifest(store_dir)
+    manifest['version'] = STORE_VERSION
+    manifest['dates_fingerprint'] = dates_fingerprint(weather_path)
+    write_manifest(store_dir, manifest)
+    return len(new_dates)
+
+def join_features(df, store_dir='data/feature_store', edges_path='data/edges.geojson',
+                  weather_path='data/weather_basel_2021-2022.csv', place='Basel, Basel, Switzerland',
+                  buffer_meters=0, cache_dir='data/osm_cache'):
+    """     Adds the date, coordinates, weather and OSM features from the feature store
+    Same result as calling create_date_features, create_coordinates_features, create_weather_features
+        and create_osm_features, but the features are only computed for the edges and dates that
+        are not in the store yet.
+
+    Parameters
+    ----------
+    df : pandas.dataframe
+        Dataframe with at least the columns 'date_utc' and 'edge_id'
+    store_dir : string
+        Folder of the feature store
+
+    Returns
+    -------
+    df : pandas.dataframe
+        Dataframe with the added features, columns in the same order as the create_* functions
+    """
+    update_edge_features(df['edge_id'], store_dir, edges_path, place, buffer_meters, cache_dir)
+    df['date_utc'] = pd.to_datetime(df['date_utc']).dt.date  #<-- Make sure date_utc is date format
+    update_date_features(df['date_utc'], store_dir, weather_path)
+    return merge_features(df, store_dir)
+
+def merge_features(df, store_dir='data/feature_store'):
+    """     Adds the stored features to df, without computing the missing ones
+    Only reads the store, so it can be called by several processes at the same time once the store
+        has the edges and dates of df (see join_features for the parameters)
+    """
+    df_edges = load_edge_features(store_dir)
+    df_dates = load_date_features(store_dir)
+    columns = df.columns.tolist()
+    weather_columns = [column for column in df_dates.columns if column not in ['date_utc'] + CALENDAR_COLUMNS]
+    osm_columns = [column for column in df_edges.columns if column not in ['edge_id'] + COORDINATES_COLUMNS]
+    df = pd.merge(df, df_dates, how="left", on="date_utc")
+    df = pd.merge(df, df_edges, how="left", on="edge_id")
+    df[osm_columns] = df[osm_columns].fillna(value=0).astype(int)
+    return df[columns + CALENDAR_COLUMNS + COORDINATES_COLUMNS + weather_columns + osm_columns]
@@ -0,0 +1,243 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.preprocessing import OneHotEncoder
+from sklearn.metrics import d2_tweedie_score
+from joblib import Parallel, delayed
+import helper_scripts.train as train
+import helper_scripts.predictor as predictor
+import copy, time
+
+def design_matrix(preprocessor, X):
+    """     Preprocessed features with an extra column of ones for the intercept
+    """
+    X = sparse.csr_matrix(preprocessor.transform(X))
+    return sparse.hstack([X, np.ones((X.shape[0], 1))], format='csr')
+
+def poisson_hessian(X, coef, alpha):
+    """     Hessian of the Poisson deviance (log link) at coef, summed over the rows of X
+    The L2 penalty of the model is added to every coefficient but the intercept
+    """
+    mu = np.exp(X @ coef)
+    penalty = np.full(X.shape[1], alpha * X.shape[0])
+    penalty[-1] = 0
+    return (X.T @ sparse.diags(mu) @ X + sparse.diags(penalty)).tocsr()
+
+def create_update_state(models, df):
+    """     Sufficient statistics of the training data, needed by update_models
+    For each litter, stores the Hessian of the Poisson deviance at the fitted coefficients.
+    Together with the coefficients, it is a quadratic summary of all the data seen so far, so
+        the models can be updated with new rows only. Computed once, after training, on the same
+        training rows as make_models (the test rows were not used to fit the coefficients).
+
+    Parameters
+    ----------
+    models : dictionary
+        Dictionary returned using the train_models() function
+    df : pandas.dataframe
+        The dataframe with features the models were trained with (input of make_models)
+
+    Returns
+    -------
+    state : dictionary
+        Each key correspond to a type of litter, with the keys 'hessian', 'rows' and 'history'
+    """
+    state = {}
+    for preprocessor, keys in predictor.group_models(models):
+        X_train, _ = train.split_train_test(train.get_features(df))
+        X = design_matrix(preprocessor, X_train)
+        for key in keys:
+            model_poisson = models[key][0].named_steps['poisson_model']
+            coef = np.append(model_poisson.coef_, model_poisson.intercept_)
+            state[key] = {'hessian': poisson_hessian(X, coef, model_poisson.alpha), 'rows': X.shape[0], 'history': []}
+    return state
+
+def check_missing_features(preprocessor, X_new):
+    """     Raises a ValueError when the numeric features of X_new have missing values
+    The models cannot predict those rows (E.g. dates without weather or edges not in the geojson)
+    """
+    numeric_columns = [columns for name, _, columns in preprocessor.transformers_ if name == 'num'][0]
+    missing = X_new[numeric_columns].isna().any()
+    if missing.any():
+        raise ValueError(f"The new rows have missing values in {list(missing.index[missing])} (E.g. dates without weather "
+                         f"or edges not in the geojson), the models were not updated")
+
+def extend_categories(preprocessor, X_new):
+    """     Adds the categories of X_new that the one hot encoder has not seen yet (E.g. new edge_ids or months)
+    The new categories are appended at the end of their feature, so the existing columns keep their order.
+
+    Returns
+    -------
+    positions : numpy.array
+        Position of each previous column (including the intercept) in the new design matrix,
+        None when there are no new categories
+    n_columns : int
+        Number of columns of the new design matrix (including the intercept)
+    """
+    cat_pipeline = preprocessor.named_transformers_['cat']
+    encoder = cat_pipeline.named_steps['onehot']
+    numeric_columns = [columns for name, _, columns in preprocessor.transformers_ if name == 'num'][0]
+    cat_columns = [columns for name, _, columns in preprocessor.transformers_ if name == 'cat'][0]
+    n_numeric = len(numeric_columns)  #<-- The scaler keeps one column per numeric feature
+    new_categories = []
+    positions = list(range(n_numeric))
+    offset = n_numeric
+    for categories, column in zip(encoder.categories_, cat_columns):
+        known = set(categories)
+        unseen = [value for value in pd.unique(X_new[column].dropna()) if value not in known]
+        positions.extend(range(offset, offset + len(categories)))
+        offset += len(categories) + len(unseen)
+        new_categories.append(np.concatenate([categories, np.array(unseen, dtype=categories.dtype)]))
+    n_columns = n_numeric + sum(len(categories) for categories in new_categories) + 1
+    positions.append(n_columns - 1)  #<-- Intercept
+    if n_columns == len(positions):
+        return None, n_columns
+    new_encoder = OneHotEncoder(categories=new_categories, handle_unknown="ignore")
+    new_encoder.fit(X_new[cat_columns])
+    cat_pipeline.steps[0] = ('onehot', new_encoder)
+    if hasattr(preprocessor, 'output_indices_'):
+        start = preprocessor.output_indices_['cat'].start
+        preprocessor.output_indices_['cat'] = slice(start, start + n_columns - 1 - n_numeric)
+    return np.array(positions), n_columns
+
+def conjugate_gradient(hessian_product, gradient, diagonal, rtol=1e-4, max_iter=250):
+    """     Solves hessian @ step = gradient with the conjugate gradient, preconditioned with the diagonal
+    The Hessian is only used through hessian_product(vector), so it is never factorized.
+    Stops when the residual is rtol times the gradient. The one hot columns are collinear (E.g. date_utc
+        with day, month and weekday), so a tighter rtol only moves the coefficients along directions
+        that do not change the predictions.
+    Returns the step and the number of Hessian products
+    """
+    inverse_diagonal = 1 / np.maximum(diagonal, 1e-12)
+    step = np.zeros_like(gradient)
+    residual = gradient.copy()
+    preconditioned = inverse_diagonal * residual
+    direction = preconditioned.copy()
+    product = residual @ preconditioned
+    stop = rtol * np.linalg.norm(gradient)
+    for iteration in range(max_iter):
+        if np.linalg.norm(residual) <= stop:
+            break
+        hessian_direction = hessian_product(direction)
+        length = product / (direction @ hessian_direction)
+        step += length * direction
+        residual -= length * hessian_direction
+        preconditioned = inverse_diagonal * residual
+        product, previous_product = residual @ preconditioned, product
+        direction = preconditioned + (product / previous_product) * direction
+    return step, iteration
+
+def newton_update(hessian, coef_previous, X, y, max_iter=20, tol=1e-6):
+    """     Minimizes the Poisson deviance of the new rows plus the quadratic summary of the previous ones
+    f(coef) = 0.5 * (coef - coef_previous)' hessian (coef - coef_previous) + sum(exp(X coef) - y * X coef)
+    Solved with Newton steps, halving the step while the objective does not decrease. Each Newton
+        step is found with the conjugate gradient, where every iteration is one product with the
+        stored Hessian and two with the new rows, so the cost does not depend on the history rows.
+    """
+    def objective(coef):
+        difference = coef - coef_previous
+        eta = X @ coef
+        return 0.5 * difference @ (hessian @ difference) + np.sum(np.exp(eta) - y * eta)
+    coef = coef_previous.copy()
+    value = objective(coef)
+    hessian_diagonal = hessian.diagonal()
+    X_squared = X.multiply(X).T.tocsr()
+    for iteration in range(1, max_iter + 1):
+        mu = np.exp(X @ coef)
+        gradient = hessian @ (coef - coef_previous) + X.T @ (mu - y)
+        step, _ = conjugate_gradient(lambda vector: hessian @ vector + X.T @ (mu * (X @ vector)),
+                                     gradient, hessian_diagonal + X_squared @ mu)
+        for _ in range(30):
+            new_value = objective(coef - step)
+            if new_value <= value:
+                break
+            step = step / 2
+        coef, improvement, value = coef - step, value - new_value, new_value
+        if np.max(np.abs(step)) < tol or improvement < tol * max(1, abs(value)):
+            break
+    return coef, iteration
+
+def update_litter(hessian, coef, positions, n_columns, X_previous, X, y, alpha):
+    """     Updates the coefficients and the Hessian of one litter with the new rows
+    Used by update_models in the worker processes, returns the new coefficients and Hessian,
+        the D2 score of the previous coefficients on the new rows, the number of Newton
+        iterations and the seconds it took
+    """
+    start_time = time.time()
+    d2_new = d2_tweedie_score(y, np.exp(X_previous @ coef), power=1)
+    if positions is not None:
+        selection = sparse.csr_matrix((np.ones(len(positions)), (positions, np.arange(len(positions)))),
+                                      shape=(n_columns, len(positions)))
+        coef = selection @ coef
+        hessian = (selection @ hessian @ selection.T).tocsr()
+    coef, iterations = newton_update(hessian, coef, X, y)
+    hessian = (hessian + poisson_hessian(X, coef, alpha)).tocsr()
+    return coef, hessian, d2_new, iterations, time.time() - start_time
+
+def update_models(models, df_new, state, window=7, n_jobs=-1):
+    """     Updates the trained models with new rows only, instead of training them again
+    For each litter, the previous data is summarized by the current coefficients and the Hessian
+        kept in state, so the cost only depends on the size of the new data. New categories
+        (E.g. new edge_ids, dates or months) are added to the one hot encoder with a coefficient of 0
+        and learned from the new rows. Before updating, the models are scored on the new rows, which
+        is a rolling holdout that shows drift. The litters are updated in parallel, as in make_models.
+    The models and the state are only changed once all the litters are updated, so they are left
+        as they were when it fails (E.g. a ValueError when the new rows have missing features).
+
+    Parameters
+    ----------
+    models : dictionary
+        Dictionary returned using the train_models() function, updated in place
+    df_new : pandas.dataframe
+        New rows with the same features the models were trained with
+    state : dictionary
+        Dictionary returned using create_update_state(), updated in place
+    window : int
+        Number of updates in the rolling D2 score
+    n_jobs : int
+        Number of worker processes, -1 uses all the cores
+
+    Returns
+    -------
+    report : dictionary
+    Each key correspond to a type of litter, which in turn contains the following:
+        'rows' : Number of new rows
+        'new_columns' : Number of new categories added to the one hot encoder
+        'd2_new' : D2 score of the previous model on the new rows
+        'd2_rolling' : Mean D2 score of the last window updates
+        'iterations' : Number of Newton iterations
+        'seconds' : Time it took in seconds to update the model
+        'time2train' : Time it took in minutes to update the model
+    """
+    X_new = train.get_features(df_new)
+    groups = predictor.group_models(models)
+    for preprocessor, _ in groups:
+        check_missing_features(preprocessor, X_new)
+    updates = []
+    for preprocessor, keys in groups:
+        X_previous = design_matrix(preprocessor, X_new)  #<-- New categories are ignored by the previous encoder
+        preprocessor = copy.deepcopy(preprocessor)  #<-- The models are only changed once every litter is updated
+        positions, n_columns = extend_categories(preprocessor, X_new)
+        X = design_matrix(preprocessor, X_new)
+        model_poissons = [models[key][0].named_steps['poisson_model'] for key in keys]
+        fitted = Parallel(n_jobs=n_jobs, max_nbytes='1M', mmap_mode='r')(
+            delayed(update_litter)(state[key]['hessian'], np.append(model_poisson.coef_, model_poisson.intercept_),
+                                   positions, n_columns, X_previous, X, df_new[key].to_numpy(dtype=float), model_poisson.alpha)
+            for key, model_poisson in zip(keys, model_poissons))
+        updates.append((preprocessor, keys, model_poissons, positions, n_columns, fitted))
+    report = {}
+    for preprocessor, keys, model_poissons, positions, n_columns, fitted in updates:
+        for key, model_poisson, (coef, hessian, d2_new, iterations, seconds) in zip(keys, model_poissons, fitted):
+            models[key][0].steps[0] = ('pre_process', preprocessor)  #<-- Equal copies now share the updated encoder
+            model_poisson.coef_ = coef[:-1]
+            model_poisson.intercept_ = coef[-1]
+            model_poisson.n_features_in_ = len(coef) - 1
+            state[key]['hessian'] = hessian
+            state[key]['rows'] += len(df_new)
+            state[key]['history'].append({'last_date': str(df_new['date_utc'].max()), 'rows': len(df_new), 'd2': d2_new})
+            rolling = state[key]['history'][-window:]
+            report[key] = {'rows': len(df_new), 'new_columns': 0 if positions is None else n_columns - len(positions),
+                           'd2_new': round(d2_new, 4), 'd2_rolling': round(float(np.mean([item['d2'] for item in rolling])), 4),
+                           'iterations': iterations, 'seconds': round(seconds, 3), 'time2train': round(seconds/60, 1)}
+            print(f"Litter {key} D2 Score on the new rows: {report[key]['d2_new']} (rolling: {report[key]['d2_rolling']})")
+    return report
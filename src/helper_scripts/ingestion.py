@@ -0,0 +1,115 @@
+import helper_scripts.data_processor as data_processor
+import pandas as pd
+import numpy as np
+
+# Partial aggregations kept for each chunk, and how the partials of several chunks are combined
+PARTIAL_AGGREGATIONS = {'sum': {'sum': 'sum'},
+                        'mean': {'sum': 'sum', 'count': 'sum'},
+                        'max': {'max': 'max'},
+                        'min': {'min': 'min'},
+                        'count': {'count': 'sum'},
+                        'first': {'first': 'first'},
+                        'last': {'last': 'last'}}
+
+def read_chunks(file_path, chunksize=500000, **read_kwargs):
+    """     Reads a raw export (CSV or Parquet) in chunks of chunksize rows
+    Extra arguments are passed to pandas.read_csv (E.g. dtype={'place.id': object})
+    """
+    if file_path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(file_path).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    else:
+        for chunk in pd.read_csv(file_path, chunksize=chunksize, **read_kwargs):
+            yield chunk
+
+def compact_dtypes(df):
+    """     Smallest dtypes for the litter counts and categorical edge_id and osm_highway
+    Integer litter counts become uint16 (or uint32 when a count is larger than 65535)
+    """
+    count_columns = data_processor.get_litter_columns(df)
+    if 'total_litter' in df.columns:
+        count_columns.append('total_litter')
+    for column in count_columns:
+        values = df[column]
+        if pd.api.types.is_integer_dtype(values) and (len(values) == 0 or values.min() >= 0):
+            df[column] = values.astype(np.uint16 if len(values) == 0 or values.max() <= np.iinfo(np.uint16).max else np.uint32)
+    for column in ['edge_id', 'osm_highway']:
+        if column in df.columns:
+            df[column] = df[column].astype('category')
+    return df
+
+def partial_aggregate(df, value_columns, aggregation_method):
+    """     Aggregates one cleaned chunk by day and edge_id, keeping the partial results of aggregation_method
+    """
+    to_agg = {'edge_osmid': ('edge_osmid', 'first'), 'osm_highway': ('osm_highway', 'first')}
+    for column in value_columns:
+        for partial in PARTIAL_AGGREGATIONS[aggregation_method]:
+            to_agg[f"{column}__{partial}"] = (column, partial)
+    return df.groupby(['date_utc', 'edge_id'], as_index=False).agg(**to_agg)
+
+def combine_partials(partials, value_columns, aggregation_method):
+    """     Combines the partial aggregations of several chunks into one
+    """
+    to_agg = {'edge_osmid': 'first', 'osm_highway': 'first'}
+    for column in value_columns:
+        for partial, combine in PARTIAL_AGGREGATIONS[aggregation_method].items():
+            to_agg[f"{column}__{partial}"] = combine
+    df = pd.concat(partials, ignore_index=True)
+    return df.groupby(['date_utc', 'edge_id'], as_index=False).agg(to_agg)
+
+def aggregate_file(file_path, aggregation_method='sum', chunksize=500000, max_buffer_rows=2000000, output_path=None, **read_kwargs):
+    """     Cleans and aggregates a raw export that does not fit in memory
+    Same result as clean_df followed by aggregate_df, but the file is read in chunks. Each chunk is
+        cleaned and aggregated by day and edge_id, and the partial aggregations are combined every
+        time they reach max_buffer_rows rows. The peak memory depends on the chunk size and the number
+        of (date, edge_id) pairs, not on the size of the file.
+
+    Parameters
+    ----------
+    file_path : string
+        Raw export, CSV or Parquet, with the same columns as the dataframe passed to clean_df
+    aggregation_method : string
+        The type of aggregation when grouping by edge_id and date, one of PARTIAL_AGGREGATIONS
+    chunksize : int
+        Number of rows read at once
+    max_buffer_rows : int
+        Number of partially aggregated rows kept before combining them
+    output_path : string
+        If given, the aggregated dataframe is also written to this Parquet file
+
+    Returns
+    -------
+    df : pandas.dataframe
+        Aggregated dataframe with compact dtypes (see compact_dtypes)
+    """
+    if aggregation_method not in PARTIAL_AGGREGATIONS:
+        raise ValueError(f"aggregation_method '{aggregation_method}' can't be computed in chunks, use one of {list(PARTIAL_AGGREGATIONS)}")
+    value_columns = None
+    partials = []
+    buffer_rows = 0
+    for chunk in read_chunks(file_path, chunksize, **read_kwargs):
+        chunk = data_processor.clean_df(chunk)
+        if value_columns is None:
+            value_columns = ['total_litter'] + data_processor.get_litter_columns(chunk)
+        chunk = compact_dtypes(chunk)
+        chunk[['edge_id', 'osm_highway']] = chunk[['edge_id', 'osm_highway']].astype(object)  #<-- Categories differ between chunks
+        partial = partial_aggregate(chunk, value_columns, aggregation_method)
+        partials.append(partial)
+        buffer_rows += len(partial)
+        if buffer_rows > max_buffer_rows and len(partials) > 1:
+            partials = [combine_partials(partials, value_columns, aggregation_method)]
+            buffer_rows = len(partials[0])
+    if value_columns is None:
+        raise ValueError(f"No rows in '{file_path}'")
+    df = combine_partials(partials, value_columns, aggregation_method)
+    for column in value_columns:
+        if aggregation_method == 'mean':
+            df[column] = df[f"{column}__sum"] / df[f"{column}__count"]
+        else:
+            df[column] = df[f"{column}__{aggregation_method}"]
+    df = df[['date_utc', 'edge_id', 'edge_osmid', 'osm_highway'] + value_columns]
+    df = compact_dtypes(df)
+    if output_path is not None:
+        df.to_parquet(output_path, index=False)
+    return df
@@ -0,0 +1,83 @@
+import json, logging, time, tracemalloc
+import warnings
+
+logger = logging.getLogger('darkzones')
+
+def create_report(run, sink=None, track_memory=True):
+    """     Creates an empty run report
+    The report is a plain dictionary that can be dumped as JSON. Stages are added with run_stage.
+
+    Parameters
+    ----------
+    run : string
+        Name of the run, E.g. 'train_models'
+    sink : None, 'log', string or function
+        Where every stage and the final report are sent: None keeps them only in the report,
+            'log' writes them to the 'darkzones' logger, any other string is a JSON lines file
+            they are appended to, and a function is called with each record
+    track_memory : boolean
+        Measure the peak of memory of each stage with tracemalloc (slows down the stages)
+    """
+    return {'run': run, 'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'), 'stages': [], 'warnings': [],
+            'sink': sink, 'track_memory': track_memory, 'start_time': time.perf_counter()}
+
+def emit(sink, record):
+    """     Sends a record to the sink of the report
+    """
+    if sink is None:
+        return
+    if callable(sink):
+        sink(record)
+    elif sink == 'log':
+        logger.info(json.dumps(record, default=str))
+    else:
+        with open(sink, 'a') as file:
+            file.write(json.dumps(record, default=str) + '\n')
+
+def run_stage(report, stage, function, df, *args, merge=False, **kwargs):
+    """     Runs function(df, *args, **kwargs) as a stage of the report
+    Records the seconds, the peak of memory (MB of Python allocations), and the rows in and out.
+    For merge stages (left merges that add features), more rows out than in means that the merged
+        table had repeated keys (fan-out). It is added to the report warnings.
+    rows_out is None when the function does not return a dataframe or an array (E.g. make_models).
+    Without report (None), only runs the function.
+    """
+    if report is None:
+        return function(df, *args, **kwargs)
+    rows_in = len(df)
+    track_memory = report['track_memory']
+    started_tracing = False
+    if track_memory:
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.start()
+            started_tracing = True
+        memory_before = tracemalloc.get_traced_memory()[0]
+    start_time = time.perf_counter()
+    result = function(df, *args, **kwargs)
+    seconds = time.perf_counter() - start_time
+    record = {'run': report['run'], 'stage': stage, 'seconds': round(seconds, 4), 'rows_in': rows_in,
+              'rows_out': len(result) if hasattr(result, 'shape') else None}  #<-- Only for dataframes and arrays
+    if track_memory:
+        record['peak_mb'] = round((tracemalloc.get_traced_memory()[1] - memory_before) / 2**20, 2)
+        if started_tracing:
+            tracemalloc.stop()
+    if merge and record['rows_out'] != rows_in:
+        message = f"Stage {stage} changed the number of rows from {rows_in} to {record['rows_out']} (repeated merge keys)"
+        report['warnings'].append({'stage': stage, 'type': 'fan-out', 'message': message})
+        warnings.warn(message)
+    report['stages'].append(record)
+    emit(report['sink'], record)
+    return result
+
+def finish_report(report, **extra):
+    """     Adds the total time and any extra information, sends the report to the sink and returns it
+    The returned report has no sink, so it can be dumped as JSON.
+    """
+    sink = report.pop('sink')
+    report.pop('track_memory')
+    report['seconds'] = round(time.perf_counter() - report.pop('start_time'), 4)
+    report.update(extra)
+    emit(sink, report)
+    return report
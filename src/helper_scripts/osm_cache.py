@@ -0,0 +1,156 @@
+import pandas as pd
+import hashlib, json, os, time
+import argparse
+import warnings
+
+def cache_key(place, tags):
+    """     Key of a place and tag set in the amenity cache
+    The key is a short hash of the place name and the sorted tags, so the same request
+        always maps to the same file.
+    """
+    request = json.dumps({'place': place, 'tags': tags}, sort_keys=True)
+    return hashlib.sha1(request.encode('utf-8')).hexdigest()[:12]
+
+def cache_paths(place, tags, cache_dir='data/osm_cache'):
+    """     Paths of the Parquet file and the metadata file for a place and tag set
+    """
+    slug = ''.join(c if c.isalnum() else '_' for c in place.lower()).strip('_')
+    name = f"{slug}_{cache_key(place, tags)}"
+    return os.path.join(cache_dir, f"{name}.parquet"), os.path.join(cache_dir, f"{name}.json")
+
+def fetch_amenities(place, tags):
+    """     Downloads the amenity nodes of a place from Open Street Maps
+    Returns a dataframe with one row per amenity node and the columns 'amenity', 'lon' and 'lat'.
+    This is the only function that needs network access, osmnx is only imported here.
+    """
+    import osmnx as ox
+    from shapely.errors import ShapelyDeprecationWarning
+    warnings.filterwarnings("ignore", category=ShapelyDeprecationWarning) 
+    amenity = ox.geometries_from_place(place, tags=tags)
+    df_osm = pd.DataFrame(amenity)
+    df_osm = df_osm[['amenity', 'geometry']].copy()  #<-- Select the only needed columns
+    df_osm['osm_id'] = df_osm.index.to_numpy()  #<-- Detach the index and assign it to a normal column
+    df_osm.reset_index(drop=True, inplace=True)  #<-- Drop index
+    osm_id_exploded = pd.DataFrame(df_osm["osm_id"].to_list(), columns=['type', 'osm'])  #<-- Explode index since it contains two indices
+    df_osm = pd.concat([df_osm, osm_id_exploded], axis=1) 
+    df_osm.drop(['osm_id', 'osm'], axis=1, inplace=True)
+    df_osm = df_osm[df_osm['type'] == 'node']  #<-- Drop Multipoligon points
+    #### Clean the coordinates from the GeoPandas geometry format to latitude and longitude columns
+    df_osm['lon'] = df_osm[df_osm['type'] == "node"]['geometry'].apply(lambda p: p.x)
+    df_osm['lat'] = df_osm[df_osm['type'] == "node"]['geometry'].apply(lambda p: p.y)
+    df_osm.drop(['geometry', 'type'], axis=1, inplace=True)
+    df_osm.reset_index(drop=True, inplace=True)
+    return df_osm
+
+def write_cache(df_osm, place, tags, cache_dir='data/osm_cache'):
+    """     Stores the amenities of a place and tag set in the cache
+    Only the columns 'lat', 'lon' and 'amenity' are kept, stored in a Parquet file.
+    The time of the download is stored next to it in a small metadata file.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    parquet_path, meta_path = cache_paths(place, tags, cache_dir)
+    df_cache = pd.DataFrame({'lat': df_osm['lat'].astype('float64'),
+                             'lon': df_osm['lon'].astype('float64'),
+                             'amenity': df_osm['amenity'].astype('category')})
+    df_cache.to_parquet(parquet_path, index=False)
+    meta = {'place': place, 'tags': tags, 'fetched_at': time.time(), 'rows': len(df_cache)}
+    with open(meta_path, 'w') as file:
+        json.dump(meta, file)
+    return parquet_path
+
+def read_cache(place, tags, cache_dir='data/osm_cache'):
+    """     Reads the cached amenities of a place and tag set
+    Returns None when the place and tag set are not in the cache.
+    """
+    parquet_path, meta_path = cache_paths(place, tags, cache_dir)
+    if not (os.path.exists(parquet_path) and os.path.exists(meta_path)):
+        return None
+    df_osm = pd.read_parquet(parquet_path)
+    df_osm['amenity'] = df_osm['amenity'].astype(str)
+    return df_osm[['amenity', 'lon', 'lat']]
+
+def cache_age_days(place, tags, cache_dir='data/osm_cache'):
+    """     Days since the cached amenities were downloaded, None if not in the cache
+    """
+    _, meta_path = cache_paths(place, tags, cache_dir)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as file:
+        meta = json.load(file)
+    return (time.time() - meta['fetched_at']) / 86400
+
+def refresh_amenities(place, tags, cache_dir='data/osm_cache'):
+    """     Downloads the amenities again and replaces the cached ones
+    """
+    df_osm = fetch_amenities(place, tags)
+    write_cache(df_osm, place, tags, cache_dir)
+    return df_osm
+
+def import_amenities(file_path, place, tags, cache_dir='data/osm_cache'):
+    """     Fills the cache from a local file instead of Open Street Maps
+    The file (CSV or Parquet) must contain the columns 'amenity', 'lat' and 'lon'.
+    Used to prepare offline machines and to test without the Overpass service.
+    """
+    if file_path.endswith('.parquet'):
+        df_osm = pd.read_parquet(file_path)
+    else:
+        df_osm = pd.read_csv(file_path)
+    write_cache(df_osm, place, tags, cache_dir)
+    return read_cache(place, tags, cache_dir)
+
+def load_amenities(place, tags, cache_dir='data/osm_cache', ttl_days=30, offline=False):
+    """     Loads the amenities of a place and tag set, downloading them only when needed
+    A warm cache never touches the network.
+
+    Parameters
+    ----------
+    place : string
+        Place name as understood by Open Street Maps (E.g. 'Basel, Basel, Switzerland')
+    tags : dictionary
+        OSM tags to download (E.g. {'amenity': ['bench', 'bar']})
+    cache_dir : string
+        Folder where the cached amenities are stored
+    ttl_days : float
+        Age in days after which the cached amenities are downloaded again. None never expires
+    offline : boolean
+        Never download, an expired cache is used as is
+
+    Returns
+    -------
+    df_osm : pandas.dataframe
+        Dataframe with the columns 'amenity', 'lon' and 'lat'
+    """
+    age = cache_age_days(place, tags, cache_dir)
+    is_fresh = age is not None and (ttl_days is None or age <= ttl_days)
+    if age is not None and (is_fresh or offline):
+        df_osm = read_cache(place, tags, cache_dir)
+        if df_osm is not None:
+            if not is_fresh:
+                warnings.warn(f"Using amenities for '{place}' cached {round(age, 1)} days ago (offline mode)")
+            return df_osm
+    if offline:
+        raise FileNotFoundError(f"No cached amenities for '{place}' in '{cache_dir}' and offline mode is on")
+    return refresh_amenities(place, tags, cache_dir)
+
+if __name__ == '__main__':
+    # Run from the src folder, E.g.: python -m helper_scripts.osm_cache refresh
+    import helper_scripts.data_processor as data_processor
+    parser = argparse.ArgumentParser(description='Manage the local Open Street Maps amenity cache')
+    parser.add_argument('command', choices=['refresh', 'import', 'info'])
+    parser.add_argument('--place', default='Basel, Basel, Switzerland')
+    parser.add_argument('--cache-dir', default='data/osm_cache')
+    parser.add_argument('--file', help='Local CSV or Parquet file with amenity, lat and lon (import only)')
+    args = parser.parse_args()
+    tags = {'amenity': sorted(data_processor.create_osm_columns())}
+    if args.command == 'refresh':
+        df_osm = refresh_amenities(args.place, tags, args.cache_dir)
+        print(f"Cached {len(df_osm)} amenities for '{args.place}'")
+    elif args.command == 'import':
+        df_osm = import_amenities(args.file, args.place, tags, args.cache_dir)
+        print(f"Cached {len(df_osm)} amenities for '{args.place}' from {args.file}")
+    else:
+        age = cache_age_days(args.place, tags, args.cache_dir)
+        if age is None:
+            print(f"No cached amenities for '{args.place}'")
+        else:
+            print(f"Amenities for '{args.place}' cached {round(age, 1)} days ago at {cache_paths(args.place, tags, args.cache_dir)[0]}")
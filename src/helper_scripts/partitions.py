@@ -0,0 +1,75 @@
+import helper_scripts.dz_creator as dz_creator
+import helper_scripts.feature_store as feature_store
+import helper_scripts.bundle as bundle
+import pandas as pd
+import numpy as np
+import os
+
+MAX_COUNT = np.iinfo(np.uint16).max  #<-- Predicted counts are stored as uint16, larger ones are clipped
+
+def partition_dates(n_dates, dates_per_partition):
+    """     Splits the date codes 0..n_dates into (first_date, last_date) ranges of dates_per_partition dates
+    """
+    return [(first_date, min(first_date + dates_per_partition, n_dates)) for first_date in range(0, n_dates, dates_per_partition)]
+
+def predict_counts(models, df):
+    """     Predicted litter counts of all the rows of df as nullable uint16, one array per litter
+    Rows without features (E.g. dates without weather) have no prediction, and are null instead of 0
+    """
+    if bundle.is_bundle(models):
+        predictions = bundle.predict(models, df, chunk_size=None)
+    else:
+        import helper_scripts.predictor as predictor
+        predictions = predictor.predict_litters(df, models, chunk_size=None).to_numpy()
+    missing = np.isnan(predictions)
+    counts = np.clip(np.rint(np.where(missing, 0, predictions)), 0, MAX_COUNT).astype(np.uint16)
+    return [pd.arrays.IntegerArray(counts[:, i], missing[:, i]) for i in range(counts.shape[1])]
+
+def predict_partition(dates, edges_dictionary_extended, observed, first_date, last_date, models, out_dir,
+                      store_dir='data/feature_store', chunk_size=100000):
+    """     Predicts the darkzones of the dates from first_date up to (not including) last_date and writes them
+    Runs in a worker process. The features are read from the feature store, which must already
+        contain all the edges and dates. Each date is written to its own Parquet file,
+        'out_dir/date_utc=YYYY-MM-DD/part-0.parquet', streaming chunk_size rows at a time, with
+        categorical edge_id and osm_highway and uint16 litter counts (null when the features
+        are missing).
+
+    Returns
+    -------
+    written : list
+        One dictionary per date with 'date_utc', 'rows' and 'path' (None when the date has no darkzones)
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    df = dz_creator.darkzones_between(dates, edges_dictionary_extended, observed, first_date, last_date)
+    df = feature_store.merge_features(df, store_dir)
+    if bundle.is_bundle(models):
+        litters = [str(key) for key in models['litters']]
+    else:
+        litters = [str(key) for key in models.keys()]
+    edge_categories = pd.CategoricalDtype(edges_dictionary_extended['edge_id'])  #<-- Same categories in every file
+    highway_categories = pd.CategoricalDtype(sorted(edges_dictionary_extended['osm_highway'].dropna().unique()))
+    written = []
+    for date in dates[first_date:last_date]:
+        df_date = df[df['date_utc'] == date]
+        path = None
+        if len(df_date) > 0:
+            path = os.path.join(out_dir, f"date_utc={date.isoformat()}", 'part-0.parquet')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            writer = None
+            for start in range(0, len(df_date), chunk_size):
+                df_chunk = df_date.iloc[start:start + chunk_size]
+                df_output = pd.DataFrame({'edge_id': pd.Categorical(df_chunk['edge_id'], dtype=edge_categories),
+                                          'edge_osmid': df_chunk['edge_osmid'].to_numpy(),
+                                          'osm_highway': pd.Categorical(df_chunk['osm_highway'], dtype=highway_categories),
+                                          'row_type': pd.Categorical(df_chunk['row_type'])})
+                counts = predict_counts(models, df_chunk)
+                for i, litter in enumerate(litters):
+                    df_output[litter] = counts[i]
+                table = pa.Table.from_pandas(df_output, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+            writer.close()
+        written.append({'date_utc': date, 'rows': len(df_date), 'path': path})
+    return written
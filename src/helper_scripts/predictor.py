@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+from joblib import hash as joblib_hash
+
+def group_models(models):
+    """     Groups the litters whose pipelines use the same fitted preprocessor
+    Models trained together with make_models share one preprocessor object. Models loaded
+        from a file have their own copy, so the preprocessors are also compared by content.
+
+    Parameters
+    ----------
+    models : dictionary
+        Dictionary returned using the train_models() function
+
+    Returns
+    -------
+    groups : list
+        List of [preprocessor, litter keys] pairs
+    """
+    groups = {}
+    hashes = {}
+    for key, model in models.items():
+        preprocessor = model[0].named_steps['pre_process']
+        if id(preprocessor) not in hashes:
+            hashes[id(preprocessor)] = joblib_hash(preprocessor)
+        group = groups.setdefault(hashes[id(preprocessor)], [preprocessor, []])
+        group[1].append(key)
+    return list(groups.values())
+
+def stack_coefficients(models, keys):
+    """     Stacks the coefficients of the Poisson models into one matrix
+    Returns the coefficients (one column per litter) and the intercepts
+    """
+    coef = np.column_stack([models[key][0].named_steps['poisson_model'].coef_ for key in keys])
+    intercept = np.array([models[key][0].named_steps['poisson_model'].intercept_ for key in keys])
+    return coef, intercept
+
+def predict_litters(df, models, chunk_size=100000):
+    """     Predicts all the litters at once
+    The dataframe is preprocessed once per shared preprocessor (instead of once per litter) and
+        all the litters are computed with a single matrix product followed by exp, the inverse of
+        the log link of the Poisson models.
+
+    Parameters
+    ----------
+    df : pandas.dataframe
+        Dataframe with the same feature columns used to train the models
+    models : dictionary
+        Dictionary returned using the train_models() function
+    chunk_size : int
+        Number of rows preprocessed at once, keeps the memory bounded. None uses all the rows
+
+    Returns
+    -------
+    df_predictions : pandas.dataframe
+        Dataframe with the same index as df and one column with the predicted counts per litter
+    """
+    columns = list(models.keys())
+    predictions = np.empty((len(df), len(columns)))
+    chunk_size = chunk_size or max(len(df), 1)
+    for preprocessor, keys in group_models(models):
+        coef, intercept = stack_coefficients(models, keys)
+        positions = [columns.index(key) for key in keys]
+        for start in range(0, len(df), chunk_size):
+            X = preprocessor.transform(df.iloc[start:start + chunk_size])
+            predictions[start:start + chunk_size, positions] = np.exp(X @ coef + intercept)
+    df_predictions = pd.DataFrame(predictions, index=df.index, columns=columns)
+    return df_predictions
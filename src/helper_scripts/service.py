@@ -0,0 +1,302 @@
+import helper_scripts.dz_creator as dz_creator
+import helper_scripts.feature_store as feature_store
+import helper_scripts.bundle as bundle
+import pandas as pd
+import numpy as np
+import asyncio, collections, datetime, json, argparse
+from urllib.parse import urlsplit, parse_qs
+
+# A resident prediction service. The models, the edge features and the calendar and weather
+#   tables are loaded once, and each date is scored once for all its edges and kept in a cache.
+#   Requests arriving at the same time are scored together in a single vectorized pass.
+
+def create_state(df, models, store_dir='data/feature_store', edges_path='data/edges.geojson',
+                 weather_path='data/weather_basel_2021-2022.csv', place='Basel, Basel, Switzerland',
+                 buffer_meters=0, cache_dir='data/osm_cache', cache_size=64, batch_window=0.005):
+    """     Loads everything the service needs in memory
+    The edges and the observed (date, edge_id) pairs come from the readings, as in create_darkzones.
+    The edge features are joined once from the feature store, the date features are loaded from it
+        and only computed for the dates that are not stored yet.
+
+    Parameters
+    ----------
+    df : pandas.dataframe
+        Raw dataframe with the readings for litter counts, the same passed to predict_darkzones()
+    models : dictionary
+        Dictionary returned using the train_models() function, or a bundle loaded with bundle.load_models()
+    store_dir : string
+        Folder of the feature store
+    cache_size : int
+        Number of dates whose predictions are kept in memory
+    batch_window : float
+        Seconds to wait for more requests before scoring, all the dates requested meanwhile
+            are scored together
+
+    Returns
+    -------
+    state : dictionary
+        Dictionary used by all the functions of the service
+    """
+    dates, df_edges, observed = dz_creator.index_edges_per_day(df)
+    feature_store.update_edge_features(df_edges['edge_id'], store_dir, edges_path, place, buffer_meters, cache_dir)
+    df_edge_features = feature_store.load_edge_features(store_dir)
+    osm_columns = [column for column in df_edge_features.columns if column not in ['edge_id'] + feature_store.COORDINATES_COLUMNS]
+    df_edges = pd.merge(df_edges, df_edge_features, how="left", on="edge_id")
+    df_edges[osm_columns] = df_edges[osm_columns].fillna(value=0).astype(int)
+    df_edges['edge_osmid'] = df_edges['edge_osmid'].astype(int)
+    feature_store.update_date_features(dates, store_dir, weather_path)
+    litters = [str(key) for key in models['litters']] if bundle.is_bundle(models) else list(models.keys())
+    return {'models': models, 'litters': litters, 'dates': dates, 'edges': df_edges, 'observed': observed,
+            'edge_positions': pd.Series(np.arange(len(df_edges)), index=df_edges['edge_id']),
+            'date_features': feature_store.load_date_features(store_dir).set_index('date_utc'),
+            'store_dir': store_dir, 'weather_path': weather_path, 'cache': collections.OrderedDict(),
+            'cache_size': cache_size, 'batch_window': batch_window, 'queue': None, 'batches': 0}
+
+def observed_edges(state, date):
+    """     Boolean mask of the edges with readings on date (all False for dates without readings)
+    """
+    n_edges = len(state['edges'])
+    seen = np.zeros(n_edges, dtype=bool)
+    date_code = np.searchsorted(state['dates'], date)
+    if date_code < len(state['dates']) and state['dates'][date_code] == date:
+        start, stop = np.searchsorted(state['observed'], [date_code * n_edges, (date_code + 1) * n_edges])
+        seen[state['observed'][start:stop] - date_code * n_edges] = True
+    return seen
+
+def load_dates(state, dates):
+    """     Makes sure the date features of dates are in memory, computing the ones not in the store yet
+    """
+    missing = [date for date in dates if date not in state['date_features'].index]
+    if missing:
+        feature_store.update_date_features(missing, state['store_dir'], state['weather_path'])
+        state['date_features'] = feature_store.load_date_features(state['store_dir']).set_index('date_utc')
+
+def dates_without_weather(state, dates):
+    """     The dates that have no weather in the weather file (E.g. future dates), they cannot be predicted
+    """
+    load_dates(state, dates)
+    weather_columns = [column for column in state['date_features'].columns if column not in feature_store.CALENDAR_COLUMNS]
+    missing = state['date_features'].reindex(dates)[weather_columns].isna().any(axis=1).to_numpy()
+    return [date for date, missing_weather in zip(dates, missing) if missing_weather]
+
+def to_counts(predictions):
+    """     Rounded counts, None (null in JSON) where the prediction is missing (E.g. an edge without coordinates)
+    """
+    missing = np.isnan(predictions)
+    counts = np.rint(np.where(missing, 0, predictions)).astype(int)
+    if missing.any():
+        counts = counts.astype(object)
+        counts[missing] = None
+    return counts
+
+def predict_dates(state, dates):
+    """     Predicts all the litters for all the edges of each date, in one vectorized pass
+    Same features and predictions as predict_darkzones(), rounded to counts
+
+    Returns
+    -------
+    predictions : dictionary
+        One numpy.array per date, with one row per edge (in the order of state['edges']) and
+            one column per litter (in the order of state['litters'])
+    """
+    load_dates(state, dates)
+    df_edges = state['edges']
+    n_edges = len(df_edges)
+    df_dates = state['date_features'].reindex(np.repeat(np.array(dates, dtype=object), n_edges))
+    df_dates.index.name = 'date_utc'
+    df = pd.concat([df_dates.reset_index(), df_edges.iloc[np.tile(np.arange(n_edges), len(dates))].reset_index(drop=True)], axis=1)
+    if bundle.is_bundle(state['models']):
+        predictions = bundle.predict(state['models'], df)
+    else:
+        import helper_scripts.predictor as predictor
+        predictions = predictor.predict_litters(df, state['models']).to_numpy()
+    predictions = to_counts(predictions)
+    return {date: predictions[i * n_edges:(i + 1) * n_edges] for i, date in enumerate(dates)}
+
+def cache_put(state, date, predictions):
+    """     Keeps the predictions of date, removing the least recently used dates above cache_size
+    """
+    state['cache'][date] = {'predictions': predictions, 'map': None}
+    state['cache'].move_to_end(date)
+    while len(state['cache']) > state['cache_size']:
+        state['cache'].popitem(last=False)
+
+async def batch_predictions(state):
+    """     Scores the queued dates in batches, runs for as long as the service
+    Waits batch_window seconds after the first request, so the dates requested meanwhile are
+        scored together. Scoring runs in a thread, so new requests keep arriving during it.
+    Dates without weather are not scored, their requests fail with a ValueError.
+    """
+    loop = asyncio.get_running_loop()
+    queue = state['queue']
+    while True:
+        requests = [await queue.get()]
+        await asyncio.sleep(state['batch_window'])
+        while not queue.empty():
+            requests.append(queue.get_nowait())
+        entries = {date: state['cache'][date] for date, _ in requests if date in state['cache']}
+        dates = sorted(set(date for date, _ in requests) - set(entries))
+        if dates:
+            try:
+                for date in await loop.run_in_executor(None, dates_without_weather, state, dates):
+                    entries[date] = ValueError(f"Weather is missing for {date}, only dates in the weather file can be predicted")
+                dates = [date for date in dates if date not in entries]
+                predictions = await loop.run_in_executor(None, predict_dates, state, dates) if dates else {}
+            except Exception as error:
+                for _, future in requests:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            if dates:
+                state['batches'] += 1
+            for date in dates:
+                cache_put(state, date, predictions[date])
+                entries[date] = state['cache'][date] if date in state['cache'] else {'predictions': predictions[date], 'map': None}
+        for date, future in requests:
+            if future.done():
+                continue
+            if isinstance(entries[date], Exception):
+                future.set_exception(entries[date])  #<-- Answered with 400 by route()
+            else:
+                future.set_result(entries[date])
+
+async def get_entry(state, date):
+    """     Cached predictions of date, queued for the next batch when they are not cached
+    """
+    if date in state['cache']:
+        state['cache'].move_to_end(date)
+        return state['cache'][date]
+    future = asyncio.get_running_loop().create_future()
+    await state['queue'].put((date, future))
+    return await future
+
+async def predict_edges(state, date, edge_ids):
+    """     Predicted litter counts of the given edges on date, whether they have readings or not
+    Returns a dictionary with the 'date', the 'edge_id' list, one list of counts per litter, and
+        the 'unknown_edges' that are not in the readings the service was started with
+    """
+    entry = await get_entry(state, date)
+    positions = state['edge_positions'].reindex(edge_ids)
+    known = positions.notna().to_numpy()
+    rows = positions[known].to_numpy(dtype=np.int64)
+    result = {'date': date.isoformat(), 'edge_id': list(np.asarray(edge_ids, dtype=object)[known])}
+    for i, litter in enumerate(state['litters']):
+        result[litter] = entry['predictions'][rows, i].tolist()
+    result['unknown_edges'] = list(np.asarray(edge_ids, dtype=object)[~known])
+    return result
+
+async def darkzone_map(state, date):
+    """     Full darkzone map of date as JSON bytes, the edges without readings with their predicted litters
+    Same rows and counts as predict_darkzones() for that date. The encoded map is cached with the predictions.
+    """
+    entry = await get_entry(state, date)
+    if entry['map'] is None:
+        missing = ~observed_edges(state, date)
+        result = {'date': date.isoformat(), 'edge_id': state['edges']['edge_id'].to_numpy()[missing].tolist()}
+        for i, litter in enumerate(state['litters']):
+            result[litter] = entry['predictions'][missing, i].tolist()
+        entry['map'] = json.dumps(result).encode('utf-8')
+    return entry['map']
+
+def parse_date(value):
+    if value is None:
+        raise ValueError("The parameter 'date' is missing (E.g. date=2022-01-31)")
+    return datetime.date.fromisoformat(value)
+
+async def route(state, method, target, body):
+    """     Answers one request, returns the HTTP status and the JSON body (bytes)
+    GET /health
+    GET /darkzones?date=YYYY-MM-DD : The darkzone map of the date
+    GET /predict?date=YYYY-MM-DD&edge_id=...&edge_id=... or POST /predict with {"date": ..., "edges": [...]} :
+        The predictions of the given edges
+    """
+    url = urlsplit(target)
+    query = parse_qs(url.query)
+    try:
+        if url.path == '/health':
+            return 200, json.dumps({'status': 'ok', 'edges': len(state['edges']), 'litters': len(state['litters']),
+                                    'cached_dates': len(state['cache']), 'batches': state['batches']}).encode('utf-8')
+        if url.path == '/darkzones' and method == 'GET':
+            return 200, await darkzone_map(state, parse_date(query.get('date', [None])[0]))
+        if url.path == '/predict' and method in ('GET', 'POST'):
+            if method == 'POST':
+                request = json.loads(body or b'{}')
+                date, edge_ids = parse_date(request.get('date')), request.get('edges', [])
+            else:
+                date, edge_ids = parse_date(query.get('date', [None])[0]), query.get('edge_id', [])
+            return 200, json.dumps(await predict_edges(state, date, edge_ids)).encode('utf-8')
+        return 404, json.dumps({'error': f"Unknown path {method} {url.path}"}).encode('utf-8')
+    except ValueError as error:
+        return 400, json.dumps({'error': str(error)}).encode('utf-8')
+    except Exception as error:
+        return 500, json.dumps({'error': repr(error)}).encode('utf-8')
+
+async def handle_connection(state, reader, writer):
+    """     Minimal HTTP/1.1 server, keeps the connection open between requests (keep-alive)
+    """
+    reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line.strip():
+                break
+            method, target, version = request_line.decode('latin-1').split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            status, payload = await route(state, method, target, body)
+            keep_alive = headers.get('connection', '').lower() != 'close' and version != 'HTTP/1.0'
+            writer.write(f"HTTP/1.1 {status} {reasons[status]}\r\nContent-Type: application/json\r\n"
+                         f"Content-Length: {len(payload)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + payload)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass  #<-- Client went away or sent a malformed request
+    finally:
+        writer.close()
+
+async def start_service(state, host='127.0.0.1', port=8765, path=None):
+    """     Starts the server and the batching task in the running event loop
+    With path, listens on a Unix socket instead of host and port. Returns the asyncio server.
+    """
+    state['queue'] = asyncio.Queue()
+    state['batcher'] = asyncio.ensure_future(batch_predictions(state))  #<-- Keep a reference, so it is not garbage collected
+    handler = lambda reader, writer: handle_connection(state, reader, writer)
+    if path is not None:
+        return await asyncio.start_unix_server(handler, path=path)
+    return await asyncio.start_server(handler, host=host, port=port)
+
+def serve(state, host='127.0.0.1', port=8765, path=None, warm_dates=()):
+    """     Runs the service until it is interrupted
+    warm_dates are scored before accepting requests, E.g. the last days shown on the dashboard
+    """
+    async def main():
+        server = await start_service(state, host, port, path)
+        for date in warm_dates:
+            await get_entry(state, date)
+        print(f"Serving darkzone predictions on {path or f'http://{host}:{port}'}")
+        async with server:
+            await server.serve_forever()
+    asyncio.run(main())
+
+if __name__ == '__main__':
+    # Run from the src folder, E.g.: python -m helper_scripts.service --models models.npz --readings readings.csv
+    parser = argparse.ArgumentParser(description='Resident darkzone prediction service')
+    parser.add_argument('--models', required=True, help='Bundle stored with bundle.export_models()')
+    parser.add_argument('--readings', required=True, help='CSV or Parquet file with the raw readings')
+    parser.add_argument('--store-dir', default='data/feature_store')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--socket', help='Listen on this Unix socket instead of host and port')
+    parser.add_argument('--cache-size', type=int, default=64, help='Number of dates kept in memory')
+    parser.add_argument('--warm-days', type=int, default=0, help='Score the last days of the readings at start')
+    args = parser.parse_args()
+    read = pd.read_parquet if args.readings.endswith('.parquet') else pd.read_csv
+    state = create_state(read(args.readings), bundle.load_models(args.models), store_dir=args.store_dir, cache_size=args.cache_size)
+    serve(state, args.host, args.port, args.socket, warm_dates=state['dates'][-args.warm_days:] if args.warm_days else [])
@@ -1,12 +1,41 @@
-from sklearn.model_selection import train_test_split
+from sklearn.model_selection import train_test_split, KFold
 from sklearn.preprocessing import StandardScaler, RobustScaler, OneHotEncoder
 from sklearn.compose import ColumnTransformer
 from sklearn.pipeline import Pipeline
 from sklearn.linear_model import PoissonRegressor
 import warnings
 from sklearn.exceptions import ConvergenceWarning
+from joblib import Parallel, delayed
 import helper_scripts.data_processor as data_processor
-import time
+import numpy as np
+import time, json
+
+DEFAULT_PARAMS = {'alpha': 1e-12, 'max_iter': 500}
+
+def create_preprocessor(X_train):
+    """     Preprocessor shared by the Poisson models
+    One Hot Encode for categorical features
+    Robust Scaler for numerical features
+    """
+    categorical_features = X_train.select_dtypes(include=['object', 'category']).columns.tolist()
+    numeric_features = X_train.select_dtypes(include=['int', 'float']).columns.tolist()
+    categorical_transformer = Pipeline(steps=[("onehot", OneHotEncoder(handle_unknown="ignore"))])
+    numeric_transformer = Pipeline(steps=[("scaler", RobustScaler())])
+    preprocessor = ColumnTransformer(transformers=[("num", numeric_transformer, numeric_features),
+                                                   ("cat", categorical_transformer, categorical_features)])
+    return preprocessor
+
+def get_features(df):
+    """     Dataframe with only the feature columns, without the litter counts
+    """
+    columns_to_drop = ['total_litter', 'total_litter_ratio']
+    columns_to_drop.extend(data_processor.get_litter_columns(df))
+    return df.drop(columns=columns_to_drop, errors='ignore')
+
+def split_train_test(*arrays):
+    """     Train/test split of make_models, the same rows for any arrays with the same number of rows
+    """
+    return train_test_split(*arrays, test_size=0.1, random_state=42)
 
 def train_poisson_model(df, output):
     """     Poisson Algorithm
@@ -35,17 +64,10 @@ def train_poisson_model(df, output):
     start_time = time.time()
     warnings.filterwarnings(action='ignore', category=ConvergenceWarning)
     output = str(output)
-    columns_to_drop = ['total_litter', 'total_litter_ratio']
-    columns_to_drop.extend(data_processor.get_litter_columns(df))
-    X = df.drop(columns=columns_to_drop, errors='ignore')
+    X = get_features(df)
     y = df[output]
     X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.1, random_state=42)
-    categorical_features = X_train.select_dtypes(include=['object', 'category']).columns.tolist()
-    numeric_features = X_train.select_dtypes(include=['int', 'float']).columns.tolist()
-    categorical_transformer = Pipeline(steps=[("onehot", OneHotEncoder(handle_unknown="ignore"))])
-    numeric_transformer = Pipeline(steps=[("scaler", RobustScaler())])
-    preprocessor = ColumnTransformer(transformers=[("num", numeric_transformer, numeric_features),
-                                                   ("cat", categorical_transformer, categorical_features)])
+    preprocessor = create_preprocessor(X_train)
     model_poisson = PoissonRegressor(alpha=1e-12, max_iter=500)
     pipeline_poisson = Pipeline(steps=[("pre_process", preprocessor), ("poisson_model", model_poisson)])
     pipeline_poisson.fit(X_train, y_train)
@@ -72,14 +94,34 @@ def get_litter_labels():
     return litter_labels
 
 
-def make_models(df, litters):
+def fit_poisson_model(X_train, y_train, alpha=1e-12, max_iter=500):
+    """     Fits a Poisson model on an already preprocessed design matrix
+    Used by make_models in the worker processes, returns the model and the minutes it took
+    """
+    start_time = time.time()
+    warnings.filterwarnings(action='ignore', category=ConvergenceWarning)
+    model_poisson = PoissonRegressor(alpha=alpha, max_iter=max_iter)
+    model_poisson.fit(X_train, y_train)
+    time2train = round((time.time() - start_time)/60, 1)
+    return model_poisson, time2train
+
+def make_models(df, litters, n_jobs=-1, params=None):
     """     Creates a dictionary that stores the ML prediction model for later use or for exporting
+    The train/test split and the preprocessor are the same for every litter, so the design matrix
+        is built only once and the Poisson models of all the litters are fitted in parallel.
+    Large arrays are memory mapped to the worker processes instead of copied.
+
     Parameters
     ----------
     df : pandas.dataframe
         Cleaned and aggegated Dataframe with added features all from data_processor script
     litters : list
         List containig the numerical values of the desired litters to train the ML models
+    n_jobs : int
+        Number of worker processes, -1 uses all the cores
+    params : dictionary or string
+        Settings of the Poisson model per litter, as returned by tune_models() (or the path of
+            its JSON file). Litters without settings use DEFAULT_PARAMS
 
     Returns
     -------
@@ -90,12 +132,25 @@ def make_models(df, litters):
         'score' : The deviance squared score for the Poisson Model
         'time2train' : Simply the time it took in minutes to fit the model
     """
+    litters = [str(litter) for litter in litters]
+    if isinstance(params, str):
+        params = load_params(params)
+    params = params or {}
+    X = get_features(df)
+    X_train, X_test, y_train, y_test = split_train_test(X, df[litters])
+    preprocessor = create_preprocessor(X_train)
+    X_train = preprocessor.fit_transform(X_train)
+    X_test = preprocessor.transform(X_test)
+    fitted = Parallel(n_jobs=n_jobs, max_nbytes='1M', mmap_mode='r')(
+        delayed(fit_poisson_model)(X_train, y_train[litter].to_numpy(), **model_params(params, litter)) for litter in litters)
     models = {}
-    for litter in litters:
-        litter = str(litter)
-        model, X_test, y_test, time2train = train_poisson_model(df, litter)
-        score = round(model.score(X_test, y_test), 4)
-        models[litter] = [model, y_test, score, time2train]
+    for litter, (model_poisson, time2train) in zip(litters, fitted):
+        model = Pipeline(steps=[("pre_process", preprocessor), ("poisson_model", model_poisson)])
+        score = round(model_poisson.score(X_test, y_test[litter]), 4)
+        print(f"The fitting took: {time2train} minutes")
+        print(f'Litter {litter} D2 Score: {score}')
+        print(f'#################################')
+        models[litter] = [model, y_test[litter], score, time2train]
     litter_labels = get_litter_labels()
     for key, value in models.items():
         for item in litter_labels:
@@ -103,5 +158,110 @@ def make_models(df, litters):
                 models[key].append(item[1])
     return models
 
+def model_params(params, litter):
+    """     Settings of the Poisson model of litter, DEFAULT_PARAMS for the missing ones
+    """
+    litter_params = params.get(str(litter), {})
+    return {key: litter_params.get(key, value) for key, value in DEFAULT_PARAMS.items()}
+
+def load_params(file_path):
+    """     Reads the settings stored by tune_models()
+    """
+    with open(file_path) as file:
+        return json.load(file)
 
+def create_folds(df, litters, n_splits=5):
+    """     Cross validation folds with the design matrices already preprocessed
+    Uses the same training rows as make_models (the test rows are left out of the tuning). For each
+        fold, the preprocessor is fitted on the training part only, and both parts are transformed
+        once, so every litter and every setting reuses the same sparse matrices.
 
+    Returns
+    -------
+    folds : list
+        One (X_fit, X_validation, y_fit, y_validation) tuple per fold, y with one column per litter
+    """
+    litters = [str(litter) for litter in litters]
+    X = get_features(df)
+    X_train, _, y_train, _ = split_train_test(X, df[litters])
+    folds = []
+    for fit_rows, validation_rows in KFold(n_splits=n_splits, shuffle=True, random_state=42).split(X_train):
+        preprocessor = create_preprocessor(X_train)
+        X_fit = preprocessor.fit_transform(X_train.iloc[fit_rows])
+        X_validation = preprocessor.transform(X_train.iloc[validation_rows])
+        folds.append((X_fit, X_validation, y_train.iloc[fit_rows].to_numpy(dtype=float), y_train.iloc[validation_rows].to_numpy(dtype=float)))
+    return folds
+
+def fit_alpha_path(X_fit, X_validation, y_fit, y_validation, alphas, max_iter=500):
+    """     Fits one Poisson model along the regularization path, from the largest alpha to the smallest
+    Each fit starts from the coefficients of the previous alpha (warm start), so the weakly
+        regularized fits, the slowest ones, only need a few iterations. The problem is convex, so
+        each fit ends at the same model as a fit of that alpha alone.
+    Returns the D2 score on the validation rows for each alpha, in the order of alphas
+    """
+    warnings.filterwarnings(action='ignore', category=ConvergenceWarning)
+    model_poisson = PoissonRegressor(max_iter=max_iter, warm_start=True)
+    scores = {}
+    for alpha in sorted(alphas, reverse=True):
+        model_poisson.set_params(alpha=alpha)
+        model_poisson.fit(X_fit, y_fit)
+        scores[alpha] = model_poisson.score(X_validation, y_validation)
+    return [scores[alpha] for alpha in alphas]
+
+def tune_models(df, litters, alphas=(1, 1e-1, 1e-2, 1e-3, 1e-4, 1e-6, 1e-12), n_splits=5, n_jobs=-1, output_path=None):
+    """     Searches the best alpha of the Poisson model for every litter with cross validation
+    The folds are preprocessed once (see create_folds). Every (litter, fold) runs the whole alpha
+        path with warm starts in a worker process, all of them in parallel, with the fold matrices
+        memory mapped to the workers instead of copied.
+    PoissonRegressor only has an L2 penalty, so alpha is the only regularization setting. max_iter
+        is not searched, since along a warm started path it would not describe the model trained
+        later by make_models. The saved max_iter is the one of DEFAULT_PARAMS.
+
+    Parameters
+    ----------
+    df : pandas.dataframe
+        Cleaned and aggegated Dataframe with added features all from data_processor script
+    litters : list
+        List containig the numerical values of the litters
+    alphas : list
+        Strengths of the L2 penalty to try
+    n_splits : int
+        Number of cross validation folds
+    n_jobs : int
+        Number of worker processes, -1 uses all the cores
+    output_path : string
+        JSON file where the best settings are saved, to be passed to make_models() later
+
+    Returns
+    -------
+    params : dictionary
+    Each key correspond to a type of litter, which in turn contains the following:
+        'alpha' : The best alpha
+        'max_iter' : The max_iter used by make_models
+        'score' : Mean D2 score of the folds with the best alpha
+        'scores' : Mean D2 score of every alpha
+    """
+    start_time = time.time()
+    litters = [str(litter) for litter in litters]
+    alphas = [float(alpha) for alpha in alphas]
+    max_iter = DEFAULT_PARAMS['max_iter']
+    folds = create_folds(df, litters, n_splits)
+    tasks = [(i, f) for i in range(len(litters)) for f in range(len(folds))]
+    fitted = Parallel(n_jobs=n_jobs, max_nbytes='1M', mmap_mode='r')(
+        delayed(fit_alpha_path)(folds[f][0], folds[f][1], folds[f][2][:, i], folds[f][3][:, i], alphas, max_iter)
+        for i, f in tasks)
+    scores = {}
+    for (i, f), path_scores in zip(tasks, fitted):
+        scores.setdefault(litters[i], []).append(path_scores)
+    params = {}
+    for litter in litters:
+        mean_scores = np.mean(scores[litter], axis=0)
+        j = int(np.argmax(mean_scores))
+        params[litter] = {'alpha': alphas[j], 'max_iter': max_iter, 'score': round(float(mean_scores[j]), 4),
+                          'scores': {str(alpha): round(float(score), 4) for alpha, score in zip(alphas, mean_scores)}}
+        print(f"Litter {litter} best alpha: {alphas[j]}, CV D2 Score: {params[litter]['score']}")
+    print(f"The tuning took: {round((time.time() - start_time)/60, 1)} minutes")
+    if output_path is not None:
+        with open(output_path, 'w') as file:
+            json.dump(params, file, indent=4)
+    return params
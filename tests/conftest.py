@@ -0,0 +1,61 @@
+import os, sys
+import numpy as np
+import pandas as pd
+import pytest
+
+# The package is run from the src folder (import helper_scripts.X), the tests do the same
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+def random_readings(rng, n_edges=60, n_days=12, detections_per_day=150, litters=('1', '2', '21')):
+    """     Raw readings of a small synthetic city, with missing edges and litter counts
+    """
+    import benchmarks.synthetic_city as synthetic_city
+    df_edges = synthetic_city.create_edges(n_edges, rng)
+    dates = pd.date_range('2021-12-25', periods=n_days).date
+    df = synthetic_city.create_raw_readings(df_edges, dates, detections_per_day, litters, rng, coverage=0.5)
+    df.loc[::53, 'edge.id'] = np.nan
+    df.loc[::11, '1'] = np.nan
+    return df
+
+def random_features(rng, n_rows=1500, litters=('1', '2', '21')):
+    """     Aggregated rows with a few features of each type, input of train.make_models
+    """
+    df = pd.DataFrame({'date_utc': pd.to_datetime('2022-01-01') + pd.to_timedelta(rng.integers(0, 20, n_rows), unit='D'),
+                       'edge_id': rng.choice([f"({i}, {i + 1}, 0)" for i in range(40)], n_rows),
+                       'osm_highway': rng.choice(['residential', 'footway', 'primary'], n_rows),
+                       'edge_length': rng.uniform(5, 300, n_rows), 'temperature_mean': rng.normal(10, 5, n_rows)})
+    df['date_utc'] = df['date_utc'].dt.date
+    for i, litter in enumerate(litters):
+        df[litter] = rng.poisson(np.exp(0.5 + 0.002 * df['edge_length'] - 0.02 * i * df['temperature_mean']))
+    return df
+
+@pytest.fixture
+def raw_readings():
+    return random_readings
+
+@pytest.fixture
+def features():
+    return random_features
+
+@pytest.fixture(scope='module')
+def trained():
+    pytest.importorskip('sklearn')
+    import helper_scripts.train as train
+    df = random_features(np.random.default_rng(3))
+    return df, train.make_models(df, ['1', '2', '21'], n_jobs=1)
+
+@pytest.fixture(scope='module')
+def city(tmp_path_factory):
+    pytest.importorskip('sklearn')
+    pytest.importorskip('pyarrow')
+    import benchmarks.synthetic_city as synthetic_city
+    import darkzones
+    out_dir = str(tmp_path_factory.mktemp('city'))
+    df_raw = synthetic_city.create_city(out_dir, n_edges=40, n_days=10, detections_per_day=200, n_amenities=100, litters=('1', '2'))
+    current_dir = os.getcwd()
+    os.chdir(out_dir)  #<-- The pipeline reads its files from the relative 'data' folder
+    try:
+        models = darkzones.train_models(df_raw.copy(), ['1', '2'])
+        yield df_raw, models
+    finally:
+        os.chdir(current_dir)
@@ -0,0 +1,17 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('sklearn')
+import helper_scripts.bundle as bundle
+
+# A bundle loaded with numpy only must give the same predictions as the sklearn pipelines
+
+def test_bundle_same_predictions_as_models(trained, features, tmp_path):
+    df, models = trained
+    df_new = features(np.random.default_rng(5), n_rows=500)
+    df_new.loc[0, 'osm_highway'] = 'unknown highway'
+    bundle.export_models(models, str(tmp_path / 'models.npz'))
+    models_bundle = bundle.load_models(str(tmp_path / 'models.npz'))
+    predictions = bundle.predict(models_bundle, df_new, chunk_size=77)
+    for i, key in enumerate(models_bundle['litters']):
+        np.testing.assert_allclose(predictions[:, i], models[key][0].predict(df_new), rtol=1e-10)
@@ -0,0 +1,19 @@
+import helper_scripts.data_processor as data_processor
+import helper_scripts.dz_creator as dz_creator
+import pandas as pd
+import numpy as np
+
+# The vectorized anti-join must give the same darkzones as the set difference of the original loop
+
+def test_create_darkzones_same_rows_as_set_difference(raw_readings):
+    df = raw_readings(np.random.default_rng(1))
+    df_clean = data_processor.aggregate_df(data_processor.clean_df(df.copy()))
+    edges = set(df_clean['edge_id'])
+    expected = [(date, edge) for date, df_date in df_clean.groupby('date_utc') for edge in edges - set(df_date['edge_id'])]
+    expected = pd.DataFrame(expected, columns=['date_utc', 'edge_id']).sort_values(['date_utc', 'edge_id']).reset_index(drop=True)
+    df_darkzones = dz_creator.create_darkzones(df.copy())
+    assert len(expected) > 100
+    assert (df_darkzones['row_type'] == 'darkzone').all()
+    pd.testing.assert_frame_equal(df_darkzones[['date_utc', 'edge_id']].sort_values(['date_utc', 'edge_id']).reset_index(drop=True), expected)
+    df_chunks = pd.concat(list(dz_creator.iter_darkzones(df.copy(), dates_per_chunk=5)), ignore_index=True)
+    pd.testing.assert_frame_equal(df_chunks, df_darkzones)
@@ -0,0 +1,24 @@
+import glob
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyarrow')
+import helper_scripts.data_processor as data_processor
+import helper_scripts.feature_store as feature_store
+import darkzones
+
+# join_features must give the same dataframe as the create_* functions, for any subset of the edges and dates
+
+def test_join_features_same_as_create_features(city, tmp_path):
+    df_raw, _ = city
+    store_dir = str(tmp_path / 'store')
+    df = data_processor.aggregate_df(data_processor.clean_df(df_raw.copy()))
+    pd.testing.assert_frame_equal(feature_store.join_features(df.copy(), store_dir), darkzones.add_features(df.copy()))
+    df_subset = df[df['date_utc'] == df['date_utc'].max()].iloc[:5].reset_index(drop=True)  #<-- A few edges of one day, from the store
+    pd.testing.assert_frame_equal(feature_store.join_features(df_subset.copy(), store_dir), darkzones.add_features(df_subset.copy()))
+    for part in glob.glob(str(tmp_path / 'store' / 'edges' / 'part-*.parquet')):  #<-- Parts written with only the amenities of their edges
+        df_part = pd.read_parquet(part)
+        osm_columns = [column for column in data_processor.create_osm_columns() if df_part[column].sum() == 0]
+        assert osm_columns
+        df_part.drop(columns=osm_columns).to_parquet(part, index=False)
+    pd.testing.assert_frame_equal(feature_store.join_features(df_subset.copy(), store_dir), darkzones.add_features(df_subset.copy()))
@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+sklearn = pytest.importorskip('sklearn')
+from scipy import sparse
+from scipy.sparse.linalg import spsolve
+import helper_scripts.train as train
+import helper_scripts.incremental as incremental
+import helper_scripts.predictor as predictor
+import darkzones
+
+def direct_newton_update(hessian, coef_previous, X, y, max_iter=20):
+    """     Newton steps solved with a sparse factorization, the solver newton_update replaced
+    """
+    coef = coef_previous.copy()
+    ridge = sparse.identity(len(coef), format='csr') * 1e-8
+    for _ in range(max_iter):
+        mu = np.exp(X @ coef)
+        gradient = hessian @ (coef - coef_previous) + X.T @ (mu - y)
+        step = spsolve((hessian + X.T @ sparse.diags(mu) @ X + ridge).tocsc(), gradient)
+        coef = coef - step
+        if np.max(np.abs(step)) < 1e-10:
+            break
+    return coef
+
+def split(df, n_new_days=2):
+    dates = sorted(df['date_utc'].unique())
+    df_history = df[df['date_utc'] < dates[-n_new_days]].reset_index(drop=True)
+    df_new = df[df['date_utc'] >= dates[-n_new_days]].reset_index(drop=True)
+    return df_history, df_new
+
+def test_update_state_only_uses_the_training_rows(features):
+    from sklearn.model_selection import train_test_split
+    df = features(np.random.default_rng(9))
+    models = train.make_models(df, ['1'], n_jobs=1)
+    state = incremental.create_update_state(models, df)
+    X_train, X_test = train_test_split(train.get_features(df), test_size=0.1, random_state=42)  #<-- The split of make_models
+    assert state['1']['rows'] == len(X_train) == len(df) - len(X_test)
+    preprocessor, _ = predictor.group_models(models)[0]
+    model_poisson = models['1'][0].named_steps['poisson_model']
+    expected = incremental.poisson_hessian(incremental.design_matrix(preprocessor, X_train),
+                                           np.append(model_poisson.coef_, model_poisson.intercept_), model_poisson.alpha)
+    np.testing.assert_allclose(state['1']['hessian'].toarray(), expected.toarray())
+
+def test_newton_update_same_predictions_as_direct_solve(features):
+    df = features(np.random.default_rng(6), n_rows=3000)
+    df_history, df_new = split(df)
+    models = train.make_models(df_history, ['1'], n_jobs=1)
+    state = incremental.create_update_state(models, df_history)
+    preprocessor, _ = predictor.group_models(models)[0]
+    X_new = train.get_features(df_new)
+    positions, n_columns = incremental.extend_categories(preprocessor, X_new)
+    selection = sparse.csr_matrix((np.ones(len(positions)), (positions, np.arange(len(positions)))), shape=(n_columns, len(positions)))
+    model_poisson = models['1'][0].named_steps['poisson_model']
+    coef = selection @ np.append(model_poisson.coef_, model_poisson.intercept_)
+    hessian = (selection @ state['1']['hessian'] @ selection.T).tocsr()
+    X = incremental.design_matrix(preprocessor, X_new)
+    y = df_new['1'].to_numpy(dtype=float)
+    expected = direct_newton_update(hessian, coef, X, y)
+    result, _ = incremental.newton_update(hessian, coef, X, y)
+    X_all = incremental.design_matrix(preprocessor, train.get_features(df))
+    np.testing.assert_allclose(np.exp(X_all @ result), np.exp(X_all @ expected), rtol=1e-6)
+
+def test_update_models_same_result_in_parallel(features):
+    df = features(np.random.default_rng(7), n_rows=3000)
+    df_history, df_new = split(df)
+    df_new.loc[:20, 'edge_id'] = 'new edge'  #<-- New category, added to the one hot encoder
+    results = []
+    for n_jobs in (1, 2):
+        models = train.make_models(df_history, ['1', '2', '21'], n_jobs=1)
+        state = incremental.create_update_state(models, df_history)
+        report = incremental.update_models(models, df_new, state, n_jobs=n_jobs)
+        assert all(value['new_columns'] >= 3 for value in report.values())  #<-- The edge and the two dates
+        results.append(predictor.predict_litters(df, models))
+    pd.testing.assert_frame_equal(results[0], results[1])
+
+def test_failed_update_leaves_the_models_unchanged(features, monkeypatch):
+    df = features(np.random.default_rng(8), n_rows=3000)
+    df_history, df_new = split(df)
+    df_new.loc[:20, 'edge_id'] = 'new edge'
+    models = train.make_models(df_history, ['1', '2'], n_jobs=1)
+    state = incremental.create_update_state(models, df_history)
+    expected = predictor.predict_litters(df, models)
+    df_missing = df_new.copy()
+    df_missing.loc[5, 'temperature_mean'] = np.nan  #<-- E.g. a date without weather
+    with pytest.raises(ValueError, match='temperature_mean'):
+        incremental.update_models(models, df_missing, state, n_jobs=1)
+    pd.testing.assert_frame_equal(predictor.predict_litters(df, models), expected)
+    def fail_second_litter(hessian, *args):
+        if hessian is state['2']['hessian']:
+            raise FloatingPointError('diverged')
+        return update_litter(hessian, *args)
+    update_litter = incremental.update_litter
+    monkeypatch.setattr(incremental, 'update_litter', fail_second_litter)
+    with pytest.raises(FloatingPointError):
+        incremental.update_models(models, df_new, state, n_jobs=1)
+    pd.testing.assert_frame_equal(predictor.predict_litters(df, models), expected)
+    assert state['1']['history'] == [] and state['2']['history'] == []
+    monkeypatch.undo()
+    incremental.update_models(models, df_new, state, n_jobs=1)
+    assert len(state['1']['history']) == 1
+
+def test_darkzones_update_models_with_one_day_of_raw_readings(city):
+    df_raw, _ = city
+    dates = pd.to_datetime(df_raw['date.utc']).dt.date
+    df_history, df_new = df_raw[dates < dates.max()], df_raw[dates == dates.max()]
+    models = darkzones.train_models(df_history.copy(), ['1', '2'])
+    state = darkzones.create_update_state(df_history.copy(), models)
+    report = darkzones.update_models(df_new.copy(), models, state)  #<-- One day only covers some of the edges and amenities
+    assert all(value['rows'] == df_new.groupby('edge.id').ngroups for value in report.values())
+    df_darkzones = darkzones.predict_darkzones(df_raw.copy(), models)
+    assert df_darkzones[['1', '2']].notna().all().all()
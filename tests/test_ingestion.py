@@ -0,0 +1,23 @@
+import helper_scripts.data_processor as data_processor
+import pandas as pd
+import numpy as np
+import pytest
+
+pytest.importorskip('pyarrow')
+import helper_scripts.ingestion as ingestion
+
+# The chunked ingestion must give the same dataframe as clean_df followed by aggregate_df
+
+@pytest.mark.parametrize('file_format', ['csv', 'parquet'])
+def test_aggregate_file_same_as_clean_and_aggregate(tmp_path, file_format, raw_readings):
+    df = raw_readings(np.random.default_rng(2))
+    file_path = str(tmp_path / f"raw.{file_format}")
+    read = pd.read_csv if file_format == 'csv' else pd.read_parquet
+    if file_format == 'csv':
+        df.to_csv(file_path, index=False)
+    else:
+        df.to_parquet(file_path, index=False)
+    for aggregation_method in ingestion.PARTIAL_AGGREGATIONS:
+        expected = data_processor.aggregate_df(data_processor.clean_df(read(file_path)), aggregation_method)
+        result = ingestion.aggregate_file(file_path, aggregation_method, chunksize=97, max_buffer_rows=300)
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False, check_categorical=False)
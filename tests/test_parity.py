@@ -0,0 +1,56 @@
+import helper_scripts.data_processor as data_processor
+import pandas as pd
+import numpy as np
+import pytest
+
+# The optimized functions must give the same results as the code they replaced.
+#   Each test compares them with a plain Python version of the original code on random data.
+
+def random_edges(rng, n_edges=300):
+    lat = 47.55 + rng.normal(0, 0.01, n_edges)
+    lon = 7.59 + rng.normal(0, 0.01, n_edges)
+    df_edges = pd.DataFrame({'edge_id': [f"({i}, {i + 1}, 0)" for i in range(n_edges)],
+                             'lat_north': lat, 'lat_south': lat + rng.uniform(-0.002, 0.002, n_edges),
+                             'lon_east': lon, 'lon_west': lon + rng.uniform(-0.002, 0.002, n_edges)})
+    df_edges.loc[[3, 17], ['lat_north', 'lat_south', 'lon_east', 'lon_west']] = np.nan  #<-- Edges missing in the geojson
+    return df_edges
+
+def random_amenities(rng, n_amenities=1500):
+    return pd.DataFrame({'amenity': rng.choice(data_processor.create_osm_columns(), n_amenities),
+                         'lat': 47.55 + rng.normal(0, 0.01, n_amenities), 'lon': 7.59 + rng.normal(0, 0.01, n_amenities)})
+
+def count_per_edge(df_edges_dict):
+    return df_edges_dict.groupby('edge_id')['amenity'].value_counts().unstack(fill_value=0).reset_index()
+
+def nested_loop_amenities(df_edges_coordinates, df_osm):
+    """     The original nested loop of create_osm_features
+    """
+    def is_between(a, x, b):
+        return min(a, b) < x < max(a, b)
+    edges_dict = []
+    for edges_row in df_edges_coordinates.itertuples():
+        for osm_row in df_osm.itertuples():
+            if is_between(edges_row.lat_south, osm_row.lat, edges_row.lat_north) and is_between(edges_row.lon_west, osm_row.lon, edges_row.lon_east):
+                edges_dict.append([edges_row.edge_id, osm_row.amenity])
+    return pd.DataFrame(edges_dict, columns=['edge_id', 'amenity'])
+
+@pytest.mark.parametrize('batch_size', [1, 7, 10000])
+def test_match_amenities_to_edges_same_counts_as_nested_loop(batch_size):
+    rng = np.random.default_rng(0)
+    df_edges, df_osm = random_edges(rng), random_amenities(rng)
+    expected = count_per_edge(nested_loop_amenities(df_edges, df_osm))
+    assert len(expected) > 50
+    result = count_per_edge(data_processor.match_amenities_to_edges(df_edges, df_osm, buffer_meters=0, batch_size=batch_size))
+    pd.testing.assert_frame_equal(result, expected)
+    assert not set(df_edges['edge_id'][[3, 17]]) & set(result['edge_id'])
+
+def test_alpha_path_same_scores_as_cold_starts(features):
+    pytest.importorskip('sklearn')
+    from sklearn.linear_model import PoissonRegressor
+    import helper_scripts.train as train
+    X_fit, X_validation, y_fit, y_validation = train.create_folds(features(np.random.default_rng(8)), ['1'], n_splits=3)[0]
+    alphas = [1e-1, 1e-12, 1e-3]
+    scores = train.fit_alpha_path(X_fit, X_validation, y_fit[:, 0], y_validation[:, 0], alphas)
+    for alpha, score in zip(alphas, scores):
+        model_poisson = PoissonRegressor(alpha=alpha, max_iter=train.DEFAULT_PARAMS['max_iter']).fit(X_fit, y_fit[:, 0])
+        np.testing.assert_allclose(score, model_poisson.score(X_validation, y_validation[:, 0]), atol=1e-3)  #<-- Up to the solver tolerance
@@ -0,0 +1,15 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('sklearn')
+import helper_scripts.partitions as partitions
+
+def test_missing_features_are_null_counts(trained, features):
+    _, models = trained
+    df = features(np.random.default_rng(9), n_rows=50)
+    df.loc[:9, 'temperature_mean'] = np.nan  #<-- Dates without weather
+    counts = partitions.predict_counts(models, df)
+    assert len(counts) == len(models)
+    for values in counts:
+        assert str(values.dtype) == 'UInt16'
+        assert values[:10].isna().all() and not values[10:].isna().any()
@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('sklearn')
+import helper_scripts.predictor as predictor
+import helper_scripts.bundle as bundle
+import darkzones
+
+# predict_litters must give the same predictions as each pipeline of the original code
+
+def test_predict_litters_same_as_each_pipeline(trained, features):
+    df, models = trained
+    df_new = features(np.random.default_rng(4), n_rows=500)
+    df_new.loc[0, 'edge_id'] = 'unknown edge'
+    df_predictions = predictor.predict_litters(df_new, models, chunk_size=77)
+    for key, value in models.items():
+        np.testing.assert_allclose(df_predictions[key].to_numpy(), value[0].predict(df_new), rtol=1e-10)
+
+def test_predict_darkzones_without_features_are_null(city, tmp_path):
+    df_raw, models = city
+    last_date = pd.to_datetime(df_raw['date.utc']).max().normalize()
+    df_future = df_raw.iloc[:5].copy()
+    df_future['date.utc'] = (last_date + pd.Timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S')  #<-- Not in the weather file
+    df = pd.concat([df_raw, df_future], ignore_index=True)
+    bundle.export_models(models, str(tmp_path / 'models.npz'))
+    for trained_models in (models, bundle.load_models(str(tmp_path / 'models.npz'))):
+        df_darkzones = darkzones.predict_darkzones(df.copy(), trained_models)
+        future = pd.to_datetime(df_darkzones['date_utc']) > last_date
+        assert future.sum() > 0 and (~future).sum() > 0
+        for litter in models.keys():
+            assert str(df_darkzones[litter].dtype) == 'Int64'
+            assert df_darkzones.loc[future, litter].isna().all()
+            assert df_darkzones.loc[~future, litter].notna().all() and (df_darkzones.loc[~future, litter] >= 0).all()
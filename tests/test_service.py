@@ -0,0 +1,34 @@
+import asyncio, json
+import numpy as np
+import pytest
+
+pytest.importorskip('sklearn')
+pytest.importorskip('pyarrow')
+import helper_scripts.service as service
+
+async def get(port, path):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f"GET {path} HTTP/1.1\r\nConnection: close\r\n\r\n".encode('latin-1'))
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    body = (await reader.read()).split(b'\r\n\r\n', 1)[1]
+    writer.close()
+    return status, json.loads(body)
+
+def test_dates_without_weather_are_rejected(city):
+    df_raw, models = city
+    state = service.create_state(df_raw.copy(), models)
+    last_date = max(state['dates'])
+    async def main():
+        server = await service.start_service(state, port=0)
+        port = server.sockets[0].getsockname()[1]
+        responses = await asyncio.gather(get(port, '/darkzones?date=2030-01-01'), get(port, f"/darkzones?date={last_date}"))
+        server.close()
+        return responses
+    (status_future, body_future), (status, body) = asyncio.run(main())
+    assert status_future == 400 and 'Weather is missing' in body_future['error']
+    assert status == 200 and all(count >= 0 for count in body['1'])  #<-- Same batch, still predicted
+
+def test_missing_predictions_are_null():
+    counts = service.to_counts(np.array([[1.4, np.nan], [2.6, 0.2]]))
+    assert counts.tolist() == [[1, None], [3, 0]]